@@ -1,23 +1,52 @@
 from __future__ import with_statement, absolute_import
 
+import atexit
+import itertools
+import os
 import re
 import sys
+import traceback
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from copy import copy
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 from functools import wraps, partial
+from hashlib import sha1
 from math import ceil
+from numbers import Number
 from operator import itemgetter
-from threading import Lock
+from random import random
+from threading import Condition, Lock, Thread
 from time import time
+from types import BuiltinFunctionType, CodeType, FunctionType
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import sqlalchemy
 from flask import _app_ctx_stack, abort, url_for
 from flask.signals import Namespace
 from sqlalchemy import orm
 from sqlalchemy.engine.url import make_url
-from sqlalchemy.event import listen
+from sqlalchemy.event import listen, remove
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
-from sqlalchemy.interfaces import ConnectionProxy
-from sqlalchemy.orm.exc import UnmappedClassError
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+from sqlalchemy.orm.exc import UnmappedClassError, UnmappedInstanceError
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import SelectBase
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.util.queue import Queue
 
 __version__ = '0.3.7'
 
@@ -27,8 +56,31 @@ _camelcase_re = re.compile(r'([A-Z]+)(?=[a-z0-9])')
 
 _signals = Namespace()
 
+# listeners can only be removed reliably from SQLAlchemy 0.9 on, the
+# version that also introduced event.contains.
+_removable_listeners = hasattr(sqlalchemy.event, 'contains')
+
 models_committed = _signals.signal('models-committed')
 before_models_committed = _signals.signal('before-models-committed')
+nplusone_detected = _signals.signal('nplusone-detected')
+
+
+class BindError(RuntimeError):
+    """Raised when an operation that ran concurrently for several binds
+    failed.  `errors` holds ``(bind, exception, traceback)`` tuples in the
+    order of the binds.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        RuntimeError.__init__(self, '\n'.join(
+            'bind %r: %s' % (bind, tb) for bind, exc, tb in errors))
+
+
+class NPlusOneError(RuntimeError):
+    """Raised in testing mode when the same statement is executed more
+    often than ``SQLALCHEMY_NPLUSONE_THRESHOLD`` in one app context.
+    """
 
 
 class _SQLAlchemyState(object):
@@ -37,19 +89,51 @@ class _SQLAlchemyState(object):
         self.db = db
         self.app = app
         self.connectors = {}
-
-
-def _include_sqlalchemy(obj):
-    for module in sqlalchemy, sqlalchemy.orm:
-        for key in module.__all__:
-            if not hasattr(obj, key):
-                setattr(obj, key, getattr(module, key))
-    # Note: obj.Table does not attempt to be a SQLAlchemy Table class.
-    obj.Table = _make_table(obj)
-    #obj.mapper = sqlalchemy.orm.mapper()#signalling_mapper \\ perhaps some addition to the mapper allowed
-    obj.relationship = _wrap_with_default_query_class(obj.relationship)
-    obj.relation = _wrap_with_default_query_class(obj.relation)
-    obj.dynamic_loader = _wrap_with_default_query_class(obj.dynamic_loader)
+        #: bind -> engine registry.  It is never mutated in place, only
+        #: replaced under the engine lock, so readers may use it unlocked.
+        self.engines = {}
+        #: ``(signature, table -> engine)`` as returned by ``get_binds``
+        self.binds = None
+        #: mapper -> ``(bind_key, engine)`` (engine is ``None`` for the
+        #: default bind) as resolved by ``_SignallingSession.get_bind``
+        self.mapper_binds = {}
+        #: bind -> :class:`_ReplicaSet` (or ``None``), replaced like engines
+        self.replicas = {}
+        #: bind -> time of the last committed write, see
+        #: ``Squll.get_last_write``
+        self.last_writes = {}
+        #: the process the pools belong to, see ``Squll._after_fork``
+        self.pid = os.getpid()
+        #: pools inherited from the parent process, never to be closed
+        self.orphaned_pools = []
+        self.dispatcher = None
+        size = app.config['SQLALCHEMY_BAKED_QUERIES_SIZE']
+        self.baked_queries = _BakedQueryCache(size) if size else None
+        self.model_cache = None
+        if app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] is not False:
+            backend = app.config['SQLALCHEMY_CACHE_BACKEND']
+            if backend is None:
+                backend = LRUCacheBackend(app.config['SQLALCHEMY_CACHE_SIZE'])
+            self.model_cache = _ModelCache(app, backend)
+
+
+_sqlalchemy_namespace = None
+
+
+def _get_sqlalchemy_namespace():
+    """Returns the names of SQLAlchemy that are exposed on :class:`Squll`
+    instances.  It is built once and shared by all instances.
+    """
+    global _sqlalchemy_namespace
+    if _sqlalchemy_namespace is None:
+        namespace = {}
+        for module in sqlalchemy.orm, sqlalchemy:
+            for key in module.__all__:
+                namespace[key] = getattr(module, key)
+        for key in 'relationship', 'relation', 'dynamic_loader':
+            namespace[key] = _wrap_with_default_query_class(namespace[key])
+        _sqlalchemy_namespace = namespace
+    return _sqlalchemy_namespace
 
 
 def _make_table(db):
@@ -82,31 +166,178 @@ def _wrap_with_default_query_class(fn):
 
 
 class _SignallingSession(Session):
-    """"""
-    def __init__(self, db, autocommit=False, autoflush=False, **options):
+    """Session of a :class:`Squll`.  Creating one is cheap, engines and
+    the table binds are only looked up once something is executed.
+    """
+    def __init__(self, db, autocommit=False, autoflush=False,
+                 track_modifications=None, **options):
         self.app = db.get_app()
+        self._state = get_state(self.app)
+        # sessions live for a request, the binds they resolve are not
+        # checked again
+        db._check_pid(self._state)
         self._model_changes = {}
+        #: ``(model, pk)`` rows to drop from the model cache on commit
+        self._stale_cache = set()
+        self._track_modifications = track_modifications
+        self._writing = False
+        #: binds written to in the current transaction
+        self._written_binds = set()
+        self._release_connections = \
+            self.app.config['SQLALCHEMY_RELEASE_CONNECTIONS']
         Session.__init__(self, autocommit=autocommit, autoflush=autoflush,
-                         bind=db.engine,
-                         binds=db.get_binds(self.app), **options)
+                         **options)
 
-    def get_bind(self, mapper, clause=None):
+    @property
+    def bind(self):
+        """The engine of the default bind unless another one was set."""
+        if self._bind is None:
+            return self._state.db.get_engine(self.app)
+        return self._bind
+
+    @bind.setter
+    def bind(self, bind):
+        self._bind = bind
+
+    def connection(self, mapper=None, clause=None, **kw):
+        # queries pass their statement, a connection requested without
+        # one may be used for anything
+        if clause is None:
+            if kw.get('bind') is None:
+                kw['bind'] = self.get_bind(mapper, _write=True)
+            else:
+                self._writing = True
+        return Session.connection(self, mapper, clause, **kw)
+
+    def get_bind(self, mapper, clause=None, _write=False):
+        # locking selects count as writes so their transaction is kept
+        if self._flushing or clause is not None and \
+                (not isinstance(clause, SelectBase) or
+                 getattr(clause, 'for_update', False)):
+            _write = True
+        if _write:
+            self._writing = True
+        bind_key = engine = None
         # mapper is None if someone tries to just get a connection
         if mapper is not None:
-            info = getattr(mapper.mapped_table, 'info', {})
+            mapper_binds = self._state.mapper_binds
+            try:
+                bind_key, engine = mapper_binds[mapper]
+            except KeyError:
+                bind_key, engine = mapper_binds[mapper] = \
+                    self._resolve_bind(mapper)
+        elif clause is not None:
+            # clauses without a mapper are bound through their tables
+            binds = self._state.db.get_binds(self.app)
+            for table in find_tables(clause, include_crud=True):
+                if table in binds:
+                    engine = binds[table]
+                    break
+        if engine is None:
+            engine = Session.get_bind(self, mapper, clause)
+        if not self.app.config['SQLALCHEMY_REPLICAS']:
+            return engine
+        if mapper is None:
+            # e.g. column queries, find the bind of the engine
+            for key, value in self._state.engines.iteritems():
+                if value is engine:
+                    bind_key = key
+                    break
+        if _write:
+            self._written_binds.add(bind_key)
+        elif self._reads_from_replica(clause, bind_key):
+            replica = self._state.db.get_replica(self.app, bind_key)
+            if replica is not None:
+                return replica
+        return engine
+
+    def _resolve_bind(self, mapper):
+        """Finds the first bind_key in the inheritance chain of the mapper
+        and returns it with its engine, ``(None, None)`` for the default
+        bind.
+        """
+        if isinstance(mapper, type):
+            mapper = orm.class_mapper(mapper)
+        for m in mapper.iterate_to_root():
+            info = getattr(m.local_table, 'info', {})
             bind_key = info.get('bind_key')
             if bind_key is not None:
-                state = get_state(self.app)
-                return state.db.get_engine(self.app, bind=bind_key)
-        return Session.get_bind(self, mapper, clause)
+                return bind_key, self._state.db.get_engine(self.app,
+                                                           bind=bind_key)
+        return None, None
+
+    def _reads_from_replica(self, clause, bind_key):
+        """Plain SELECTs go to a replica unless this session wrote in the
+        current transaction or the bind was written to less than
+        ``SQLALCHEMY_REPLICA_PIN_WINDOW`` seconds ago.
+        """
+        if not isinstance(clause, SelectBase) or self._writing:
+            return False
+        last_write = self._state.db.get_last_write(self.app, bind_key)
+        return last_write is None or _timer() - last_write >= \
+            self.app.config['SQLALCHEMY_REPLICA_PIN_WINDOW']
+
+    def _end_transaction(self, committed=True):
+        if self._writing:
+            self._writing = False
+            if committed and self._written_binds:
+                now = _timer()
+                for bind_key in self._written_binds:
+                    self._state.db.set_last_write(self.app, bind_key, now)
+            self._written_binds.clear()
+
+    def _release_read_transaction(self):
+        """With ``SQLALCHEMY_RELEASE_CONNECTIONS`` a transaction that only
+        read is closed after a query so that its connections go back to
+        the pool.  Loaded instances stay in the session unexpired, the
+        next query starts a new transaction.
+        """
+        transaction = self.transaction
+        if transaction is not None and transaction._connections and \
+                transaction._parent is None and not transaction.nested and \
+                not self._writing and self._is_clean():
+            transaction.close()
+
+    def tracks_modifications(self):
+        """Tells if model changes are recorded for the signals right now."""
+        return _track_modifications(self.app, self._track_modifications)
+
+
+def _track_modifications(app, track=None):
+    """Model changes are tracked when ``SQLALCHEMY_TRACK_MODIFICATIONS``
+    (or `track` given for a session) says so, or if it is `None` as long
+    as a receiver is connected to one of the commit signals.
+    """
+    if track is None:
+        track = app.config['SQLALCHEMY_TRACK_MODIFICATIONS']
+    if track is None:
+        return _has_receivers(models_committed, app) or \
+            _has_receivers(before_models_committed, app)
+    return track
+
+
+_signal_events_registered = False
+
+
+def _register_signal_events():
+    global _signal_events_registered
+    if not _signal_events_registered:
+        _signal_events_registered = True
+        _MapperSignalEvents(orm.mapper).register()
+        _SessionSignalEvents().register()
 
 
 class _SessionSignalEvents(object):
 
     def register(self):
-        listen(Session, 'before_commit', self.squll_before_commit)
-        listen(Session, 'after_commit', self.squll_after_commit)
-        listen(Session, 'after_rollback', self.squll_after_rollback)
+        listen(_SignallingSession, 'before_commit', self.squll_before_commit)
+        listen(_SignallingSession, 'after_commit', self.squll_after_commit)
+        listen(_SignallingSession, 'after_rollback',
+               self.squll_after_rollback)
+        listen(_SignallingSession, 'after_bulk_update',
+               self.squll_after_bulk)
+        listen(_SignallingSession, 'after_bulk_delete',
+               self.squll_after_bulk)
 
     @staticmethod
     def squll_before_commit(session):
@@ -118,12 +349,156 @@ class _SessionSignalEvents(object):
     def squll_after_commit(session):
         d = session._model_changes
         if d:
-            models_committed.send(session.app, changes=d.values())
+            dispatcher = _get_commit_dispatcher(session.app)
+            if dispatcher is None:
+                models_committed.send(session.app, changes=d.values())
+            else:
+                dispatcher.submit(d.items())
             d.clear()
+        stale = session._stale_cache
+        if stale:
+            cache = session._state.model_cache
+            for cls, pk in stale:
+                cache.drop(cls, pk)
+            stale.clear()
+        session._end_transaction()
 
     @staticmethod
     def squll_after_rollback(session):
         session._model_changes.clear()
+        session._stale_cache.clear()
+        session._end_transaction(committed=False)
+
+    @staticmethod
+    def squll_after_bulk(session, query, query_context, result):
+        # the rows are not known, all entries of the model are dropped
+        mapper = query._mapper_zero()
+        cache = session._state.model_cache
+        if cache is not None and cache.ttl(mapper):
+            session._stale_cache.add((mapper.class_, None))
+
+
+class _CommitDispatcher(object):
+    """Sends `models_committed` for an app from a pool of worker threads.
+
+    Pending changes are keyed by ``(model, pk)`` so that a change that is
+    still waiting is replaced by a newer one for the same row.  If more
+    than `maxsize` changes are pending :meth:`submit` waits up to
+    `timeout` seconds for room and then sends the changes itself.
+
+    Receivers run in an app context of the worker thread.  The committed
+    instances are expired and belong to another session by then, so this
+    is best combined with ``SQLALCHEMY_COMPACT_MODEL_CHANGES``.
+    """
+
+    batch_size = 100
+
+    def __init__(self, app, workers=2, maxsize=1000, timeout=1.0):
+        self.app = app
+        self.workers = workers
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._cond = Condition()
+        self._pending = OrderedDict()
+        self._busy = 0
+        self._threads = []
+        self._closed = False
+
+    def submit(self, changes):
+        """Queues ``(key, change)`` pairs."""
+        with self._cond:
+            if not self._threads:
+                self._start()
+            deadline = _timer() + self.timeout
+            while len(self._pending) >= self.maxsize:
+                remaining = deadline - _timer()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            else:
+                for key, change in changes:
+                    self._pending.pop(key, None)
+                    self._pending[key] = change
+                self._cond.notify_all()
+                return
+        models_committed.send(self.app,
+                              changes=[change for key, change in changes])
+
+    def flush(self, timeout=None):
+        """Waits until all queued changes were sent."""
+        deadline = timeout is not None and _timer() + timeout or None
+        with self._cond:
+            while self._pending or self._busy:
+                if deadline is None:
+                    self._cond.wait(1.0)
+                else:
+                    remaining = deadline - _timer()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _start(self):
+        for i in xrange(self.workers):
+            thread = Thread(target=self._work,
+                            name='squll-dispatch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                count = min(len(self._pending), self.batch_size)
+                changes = [self._pending.popitem(last=False)[1]
+                           for _ in xrange(count)]
+                self._busy += 1
+                self._cond.notify_all()
+            try:
+                with self.app.app_context():
+                    models_committed.send(self.app, changes=changes)
+            except Exception:
+                self.app.logger.exception('Error in models_committed '
+                                          'receiver')
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+
+_dispatcher_lock = Lock()
+
+
+def _get_commit_dispatcher(app):
+    """Returns the dispatcher of the app or `None` if the signal is sent
+    synchronously, which is always the case in testing mode.
+    """
+    config = app.config
+    if config['SQLALCHEMY_COMMIT_DISPATCH'] != 'async' or config['TESTING']:
+        return None
+    state = get_state(app)
+    if state.dispatcher is None:
+        with _dispatcher_lock:
+            if state.dispatcher is None:
+                dispatcher = _CommitDispatcher(
+                    app, config['SQLALCHEMY_DISPATCH_WORKERS'],
+                    config['SQLALCHEMY_DISPATCH_QUEUE_SIZE'],
+                    config['SQLALCHEMY_DISPATCH_TIMEOUT'])
+                atexit.register(dispatcher.close)
+                state.dispatcher = dispatcher
+    return state.dispatcher
 
 
 class _MapperSignalEvents(object):
@@ -147,8 +522,24 @@ class _MapperSignalEvents(object):
 
     @staticmethod
     def _record(mapper, target, operation):
-        pk = tuple(mapper.primary_key_from_instance(target))
-        orm.object_session(target)._model_changes[pk] = (target, operation)
+        session = orm.object_session(target)
+        if not isinstance(session, _SignallingSession):
+            return
+        pk = None
+        if operation != 'insert':
+            cache = session._state.model_cache
+            if cache is not None and cache.ttl(mapper):
+                pk = tuple(mapper.primary_key_from_instance(target))
+                session._stale_cache.add((mapper.class_, pk))
+        if not session.tracks_modifications():
+            return
+        if pk is None:
+            pk = tuple(mapper.primary_key_from_instance(target))
+        if session.app.config['SQLALCHEMY_COMPACT_MODEL_CHANGES']:
+            change = (mapper.class_, pk, operation)
+        else:
+            change = (target, operation)
+        session._model_changes[mapper.class_, pk] = change
 
 
 class _BoundDeclarativeMeta(DeclarativeMeta):
@@ -173,12 +564,241 @@ class _BoundDeclarativeMeta(DeclarativeMeta):
         return DeclarativeMeta.__new__(cls, name, bases, d)
 
     def __init__(self, name, bases, d):
-        bind_key = d.pop('__bind_key__', None)
+        bind_key = d.pop('__bind_key__', None) or \
+            getattr(self, '__bind_key__', None)
         DeclarativeMeta.__init__(self, name, bases, d)
         if bind_key is not None:
             self.__table__.info['bind_key'] = bind_key
 
 
+def _has_receivers(signal, sender):
+    has_receivers_for = getattr(signal, 'has_receivers_for', None)
+    return has_receivers_for is not None and has_receivers_for(sender)
+
+
+def _bulk_columns(mapper, table):
+    """Maps attribute and column names to the columns of `table`."""
+    rv = dict((column.key, column) for column in table.c)
+    for prop in mapper.column_attrs:
+        column = prop.columns[0]
+        if column.table is table:
+            rv[prop.key] = column
+    return rv
+
+
+def _bulk_changes(model, pk, chunk, params, ops, summarize, compact):
+    if summarize:
+        if compact:
+            return [(model, None, op) for op in sorted(set(ops))]
+        return [(model, op) for op in sorted(set(ops))]
+    if compact:
+        return [(model, tuple(p.get(c.key) for c in pk), op)
+                for p, op in zip(params, ops)]
+    return zip(chunk, ops)
+
+
+#: bound parameters per existence check of :func:`_bulk_existing`, this
+#: also keeps the ``OR`` chain of composite keys within the expression
+#: depth limits of the databases
+_bulk_existing_params = 500
+
+
+def _bulk_existing(conn, pk, params):
+    """Returns the primary key tuples of `params` that exist already."""
+    rv = set()
+    step = max(1, _bulk_existing_params // len(pk))
+    for offset in xrange(0, len(params), step):
+        batch = params[offset:offset + step]
+        if len(pk) == 1:
+            criterion = pk[0].in_([p[pk[0].key] for p in batch])
+        else:
+            criterion = sqlalchemy.or_(*[
+                sqlalchemy.and_(*[c == p[c.key] for c in pk])
+                for p in batch])
+        query = sqlalchemy.select(list(pk)).where(criterion)
+        rv.update(tuple(row) for row in conn.execute(query))
+    return rv
+
+
+def _bulk_groups(params):
+    """Groups `params` by their keys.  An executemany compiles its
+    statement from the first dictionary only, other keys would be lost.
+    """
+    groups = OrderedDict()
+    for p in params:
+        groups.setdefault(frozenset(p), []).append(p)
+    return groups.values()
+
+
+def _bulk_insert(conn, table, params):
+    for group in _bulk_groups(params):
+        conn.execute(table.insert(), group)
+
+
+def _bulk_update(conn, table, pk, params):
+    # the primary key values are renamed, a bind parameter must not use
+    # the name of a column that is SET
+    statement = table.update().where(sqlalchemy.and_(*[
+        c == sqlalchemy.bindparam('_pk_' + c.key) for c in pk]))
+    pk_keys = set(c.key for c in pk)
+    for group in _bulk_groups(params):
+        conn.execute(statement, [
+            dict(('_pk_' + key if key in pk_keys else key, value)
+                 for key, value in p.iteritems()) for p in group])
+
+
+def _timed(fn, *args):
+    start = _timer()
+    rv = fn(*args)
+    return _timer() - start, rv
+
+
+def _run_per_bind(jobs, fn, workers=None):
+    """Calls ``fn(bind, engine)`` for the `jobs` from a pool of threads
+    and returns ``(seconds, result)`` per job.  Once all jobs are done a
+    :exc:`BindError` reports the failures in the order of the jobs.
+    """
+    results = [None] * len(jobs)
+    errors = {}
+    pending = []
+
+    def run(index, bind, engine):
+        try:
+            results[index] = _timed(fn, bind, engine)
+        except Exception as e:
+            errors[index] = (bind, e, traceback.format_exc())
+
+    for index, (bind, engine) in enumerate(jobs):
+        # thread local pools (in-memory SQLite) stay in this thread
+        if isinstance(engine.pool, SingletonThreadPool):
+            run(index, bind, engine)
+        else:
+            pending.append((index, bind, engine))
+    lock = Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, bind, engine = pending.pop(0)
+            run(index, bind, engine)
+
+    threads = [Thread(target=work)
+               for _ in xrange(min(workers or len(pending), len(pending)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BindError([errors[index] for index in sorted(errors)])
+    return results
+
+
+# only base tables are fingerprinted, views are not reflected
+_fingerprint_queries = {
+    'sqlite': "SELECT tbl_name, type, name, sql FROM sqlite_master "
+              "WHERE tbl_name NOT LIKE 'sqlite_%' AND tbl_name IN "
+              "(SELECT name FROM sqlite_master WHERE type = 'table')",
+    'postgresql': "SELECT CAST(table_name AS text), "
+                  "CAST(column_name AS text), CAST(data_type AS text), "
+                  "CAST(is_nullable AS text), "
+                  "CAST(column_default AS text), "
+                  "CAST(ordinal_position AS text) "
+                  "FROM information_schema.columns "
+                  "WHERE table_schema = current_schema() AND table_name IN "
+                  "(SELECT table_name FROM information_schema.tables "
+                  "WHERE table_schema = current_schema() "
+                  "AND table_type = 'BASE TABLE') "
+                  "UNION ALL SELECT CAST(c.relname AS text), "
+                  "CAST(o.conname AS text), "
+                  "pg_get_constraintdef(o.oid), NULL, NULL, NULL "
+                  "FROM pg_constraint o "
+                  "JOIN pg_class c ON c.oid = o.conrelid "
+                  "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                  "WHERE n.nspname = current_schema() "
+                  "AND c.relkind IN ('r', 'p') "
+                  "UNION ALL SELECT CAST(c.relname AS text), "
+                  "CAST(i.relname AS text), "
+                  "pg_get_indexdef(i.oid), NULL, NULL, NULL "
+                  "FROM pg_index x "
+                  "JOIN pg_class c ON c.oid = x.indrelid "
+                  "JOIN pg_class i ON i.oid = x.indexrelid "
+                  "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                  "WHERE n.nspname = current_schema() "
+                  "AND c.relkind IN ('r', 'p')",
+    'mysql': "SELECT c.table_name, c.column_name, c.column_type, "
+             "c.is_nullable, c.column_default, c.column_key "
+             "FROM information_schema.columns c "
+             "JOIN information_schema.tables t "
+             "ON t.table_schema = c.table_schema "
+             "AND t.table_name = c.table_name "
+             "WHERE c.table_schema = DATABASE() "
+             "AND t.table_type = 'BASE TABLE' "
+             "UNION ALL SELECT table_name, index_name, column_name, "
+             "seq_in_index, non_unique, index_type "
+             "FROM information_schema.statistics "
+             "WHERE table_schema = DATABASE() "
+             "UNION ALL SELECT table_name, constraint_name, column_name, "
+             "referenced_table_name, referenced_column_name, "
+             "ordinal_position FROM information_schema.key_column_usage "
+             "WHERE table_schema = DATABASE()",
+}
+
+
+def _schema_fingerprints(engine):
+    """Returns a table name -> fingerprint dict of the schema with a
+    single query, or `None` if the dialect is not supported.
+    """
+    query = _fingerprint_queries.get(engine.dialect.name)
+    if query is None:
+        return None
+    rows = {}
+    for row in engine.execute(query):
+        rows.setdefault(row[0], []).append(tuple(row[1:]))
+    return dict((name, sha1(repr(sorted(table_rows))).hexdigest())
+                for name, table_rows in rows.iteritems())
+
+
+def _reflect_cached(engine, cache_dir):
+    """Reflects the tables of `engine` using the reflection cache in
+    `cache_dir`.  Tables whose fingerprint did not change are copied from
+    the cache, only the others are reflected from the database.  Returns
+    `None` if the schema of the dialect can not be fingerprinted.
+    """
+    fingerprints = _schema_fingerprints(engine)
+    if fingerprints is None:
+        return None
+    path = os.path.join(cache_dir, 'squll-reflect-%s.pickle' %
+                        sha1(str(engine.url)).hexdigest())
+    cached_fingerprints, cached = {}, None
+    try:
+        with open(path, 'rb') as f:
+            version, cached_fingerprints, cached = pickle.load(f)
+        if version != sqlalchemy.__version__:
+            cached_fingerprints, cached = {}, None
+    except Exception:
+        pass
+
+    metadata = sqlalchemy.MetaData()
+    fresh = set(name for name, fingerprint in fingerprints.iteritems()
+                if cached_fingerprints.get(name) == fingerprint)
+    if cached is not None:
+        for table in cached.sorted_tables:
+            if table.name in fresh:
+                table.tometadata(metadata)
+    stale = sorted(set(fingerprints) - fresh)
+    if stale:
+        metadata.reflect(bind=engine, only=stale)
+    if stale or cached_fingerprints != fingerprints:
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((sqlalchemy.__version__, fingerprints, metadata), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    return metadata
+
+
 def get_state(app):
     assert 'sqlalchemy' in app.extensions, \
         'The sqlalchemy extension was not registered to the current ' \
@@ -188,13 +808,20 @@ def get_state(app):
 
 class Pagination(object):
 
-    def __init__(self, query, page, endpoint, per_page, total, items):
+    def __init__(self, query, page, endpoint, per_page, total, items,
+                 has_next=None, estimated=False, **options):
         self.query = query
         self.page = page
         self.endpoint = endpoint
         self.per_page = per_page
+        #: the number of items, `None` if it was not counted.  If
+        #: :attr:`estimated` is set it is only an estimate.
         self.total = total
         self.items = items
+        self.estimated = estimated
+        #: the extra arguments to paginate, passed on by prev and next
+        self.options = options
+        self._has_next = has_next
 
     def call_endpoint(self, which_page):
         if self.endpoint:
@@ -202,12 +829,20 @@ class Pagination(object):
 
     @property
     def pages(self):
-        return int(ceil(self.total / float(self.per_page)))
+        if self.total is None:
+            return self.page + (self._has_next and 1 or 0)
+        pages = int(ceil(self.total / float(self.per_page)))
+        if self.estimated and self._has_next is not None:
+            if not self._has_next:
+                return self.page
+            return max(pages, self.page + 1)
+        return pages
 
     def prev(self, error_out=False):
         assert self.query is not None, 'a query object is required ' \
                                        'for this method to work'
-        return self.query.paginate(self.page - 1, self.endpoint, self.per_page, error_out)
+        return self.query.paginate(self.page - 1, self.endpoint,
+                                   self.per_page, error_out, **self.options)
 
     @property
     def prev_num(self):
@@ -220,10 +855,13 @@ class Pagination(object):
     def next(self, error_out=False):
         assert self.query is not None, 'a query object is required ' \
                                        'for this method to work'
-        return self.query.paginate(self.page + 1, self.endpoint, self.per_page, error_out)
+        return self.query.paginate(self.page + 1, self.endpoint,
+                                   self.per_page, error_out, **self.options)
 
     @property
     def has_next(self):
+        if self._has_next is not None:
+            return self._has_next
         return self.page < self.pages
 
     @property
@@ -244,8 +882,575 @@ class Pagination(object):
                 last = num
 
 
+class _CountCache(object):
+    """Remembers exact totals of paginated queries for a while."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._totals = {}
+
+    def get(self, key):
+        rv = self._totals.get(key)
+        if rv is not None and rv[0] > _timer():
+            return rv[1]
+
+    def set(self, key, total, ttl):
+        now = _timer()
+        with self._lock:
+            if len(self._totals) >= self.maxsize:
+                for k, (expires, _) in self._totals.items():
+                    if expires <= now:
+                        del self._totals[k]
+                if len(self._totals) >= self.maxsize:
+                    self._totals.clear()
+            self._totals[key] = (now + ttl, total)
+
+
+_count_cache = _CountCache()
+
+
+class SeekPagination(object):
+    """A page of a keyset (seek) pagination as returned by
+    :meth:`BaseQuery.seek_paginate`.  Instead of page numbers it carries
+    opaque cursors for the neighbouring pages.
+    """
+
+    def __init__(self, query, order_columns, endpoint, per_page, items,
+                 has_prev, has_next):
+        self.query = query
+        self.order_columns = order_columns
+        self.endpoint = endpoint
+        self.per_page = per_page
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+    def _cursor_for(self, item):
+        columns = [column for column, desc
+                   in _seek_columns(self.order_columns)]
+        return _encode_cursor([_seek_value(item, c) for c in columns])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return self._cursor_for(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return self._cursor_for(self.items[0])
+
+    def call_endpoint(self, **cursor):
+        if self.endpoint:
+            return url_for(endpoint=self.endpoint, **cursor)
+
+    @property
+    def next_url(self):
+        if self.has_next:
+            return self.call_endpoint(after=self.next_cursor)
+
+    @property
+    def prev_url(self):
+        if self.has_prev:
+            return self.call_endpoint(before=self.prev_cursor)
+
+    def next(self, error_out=False):
+        assert self.query is not None, 'a query object is required ' \
+                                       'for this method to work'
+        return self.query.seek_paginate(self.order_columns,
+                                        after=self.next_cursor,
+                                        per_page=self.per_page,
+                                        endpoint=self.endpoint,
+                                        error_out=error_out)
+
+    def prev(self, error_out=False):
+        assert self.query is not None, 'a query object is required ' \
+                                       'for this method to work'
+        return self.query.seek_paginate(self.order_columns,
+                                        before=self.prev_cursor,
+                                        per_page=self.per_page,
+                                        endpoint=self.endpoint,
+                                        error_out=error_out)
+
+
+def _seek_columns(order_columns):
+    """Splits ``column.desc()``/``column.asc()`` into (column, descending)."""
+    rv = []
+    for column in order_columns:
+        modifier = getattr(column, 'modifier', None)
+        if modifier is operators.desc_op or modifier is operators.asc_op:
+            rv.append((column.element, modifier is operators.desc_op))
+        else:
+            if hasattr(column, '__clause_element__'):
+                column = column.__clause_element__()
+            rv.append((column, False))
+    return rv
+
+
+def _seek_value(item, column):
+    try:
+        mapper = orm.object_mapper(item)
+    except UnmappedInstanceError:
+        return getattr(item, column.key)
+    return getattr(item, mapper.get_property_by_column(column).key)
+
+
+def _seek_criterion(columns, values, reverse):
+    """Builds ``(a > x) OR (a = x AND b > y) OR ...`` which handles mixed
+    sort directions, unlike a row value comparison.
+    """
+    clauses = []
+    for i, (column, desc) in enumerate(columns):
+        if desc != reverse:
+            cmp = column < values[i]
+        else:
+            cmp = column > values[i]
+        equal = [c == v for (c, _), v in zip(columns[:i], values)]
+        clauses.append(sqlalchemy.and_(*(equal + [cmp])))
+    return sqlalchemy.or_(*clauses)
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime):
+        return {'$dt': [value.year, value.month, value.day, value.hour,
+                        value.minute, value.second, value.microsecond]}
+    if isinstance(value, date):
+        return {'$d': [value.year, value.month, value.day]}
+    if isinstance(value, Decimal):
+        return {'$dec': str(value)}
+    raise TypeError('%r can not be used in a cursor' % value)
+
+
+def _decode_cursor_value(d):
+    if '$dt' in d:
+        return datetime(*d['$dt'])
+    if '$d' in d:
+        return date(*d['$d'])
+    if '$dec' in d:
+        try:
+            return Decimal(d['$dec'])
+        except InvalidOperation:
+            raise ValueError('invalid decimal in cursor')
+    return d
+
+
+#: the values a decoded cursor may hold, cursors come from the client
+_cursor_types = (basestring, Number, date, datetime, Decimal, type(None))
+
+
+def _encode_cursor(values):
+    data = json.dumps(values, default=_encode_cursor_value,
+                      separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    cursor = str(cursor)
+    data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    data = data.decode('utf-8')
+    values = json.loads(data, object_hook=_decode_cursor_value)
+    if not isinstance(values, list) or not all(
+            isinstance(value, _cursor_types) for value in values):
+        raise ValueError('invalid cursor')
+    return values
+
+
+def _expunge_all(session, rows, keep):
+    """Expunges the instances in `rows` from `session`, except those with
+    unflushed changes and those whose identity key is in `keep`.
+    """
+    for row in rows:
+        for obj in isinstance(row, tuple) and row or (row,):
+            try:
+                if obj not in session:
+                    continue
+            except UnmappedInstanceError:
+                continue
+            state = instance_state(obj)
+            if not state.modified and state.key not in keep:
+                session.expunge(obj)
+
+
+class CacheBackend(object):
+    """Storage of the second level model cache.  Keys are strings and
+    values byte strings, so a backend may keep them out of process.
+    """
+
+    def get(self, key):
+        """Returns the value or `None` if the key is missing or expired."""
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+class LRUCacheBackend(CacheBackend):
+    """In-process backend that keeps up to `maxsize` entries."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires <= _timer():
+                return None
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (_timer() + ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class _ModelCache(object):
+    """Caches the column values of models that set ``__cache__`` (`True`
+    or a TTL in seconds) by primary key.  Rows that sessions update or
+    delete are dropped once the session commits, whether or not it tracks
+    modifications; ``Query.update``/``Query.delete`` and bulk operations
+    without primary keys drop all entries of the model in this process.
+    Writes that bypass the ORM and the bulk methods of :class:`Squll`
+    are only noticed when the TTL expires.
+    """
+
+    def __init__(self, app, backend):
+        self.app = app
+        self.backend = backend
+        self._generations = {}
+        self.hits = self.misses = self.invalidations = 0
+
+    def ttl(self, mapper):
+        ttl = getattr(mapper.class_, '__cache__', None)
+        if not ttl or mapper.inherits is not None or \
+                mapper.polymorphic_on is not None:
+            return None
+        if ttl is True:
+            return self.app.config['SQLALCHEMY_CACHE_TTL']
+        return ttl
+
+    def _key(self, cls, pk):
+        return '%s.%s/%d/%r' % (cls.__module__, cls.__name__,
+                                self._generations.get(cls, 0), tuple(pk))
+
+    def get(self, session, mapper, identity_key):
+        value = self.backend.get(self._key(*identity_key[:2]))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        instance = mapper.class_manager.new_instance()
+        for key, value in pickle.loads(value).iteritems():
+            set_committed_value(instance, key, value)
+        instance_state(instance).key = identity_key
+        return session.merge(instance, load=False)
+
+    def set(self, mapper, instance, ttl):
+        state = instance_state(instance)
+        values = dict((prop.key, state.dict[prop.key])
+                      for prop in mapper.column_attrs
+                      if prop.key in state.dict)
+        self.backend.set(self._key(*state.key[:2]),
+                         pickle.dumps(values, pickle.HIGHEST_PROTOCOL), ttl)
+
+    def invalidate(self, sender, changes):
+        """Drops the rows named by `changes`, which take the forms of the
+        `models_committed` change records.
+        """
+        for change in changes:
+            if len(change) == 3:
+                cls, pk = change[:2]
+            elif isinstance(change[0], type):
+                cls, pk = change[0], None
+            elif isinstance(change[0], dict):
+                # rows of the bulk operations, see Squll._bulk_execute
+                continue
+            else:
+                key = instance_state(change[0]).key
+                if key is None:
+                    continue
+                cls, pk = key[:2]
+            self.drop(cls, pk)
+
+    def drop(self, cls, pk):
+        """Drops a row, or all rows of `cls` if `pk` is `None`."""
+        if pk is None:
+            self._generations[cls] = self._generations.get(cls, 0) + 1
+        else:
+            self.backend.delete(self._key(cls, pk))
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
+
+
+class _BakedQueryCache(object):
+    """LRU of prepared queries and their compiled statements, keyed by the
+    shape of the query.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'capacity': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class _BakedEntry(object):
+    """A prepared query without session, its compiled context once it was
+    executed and, with `compile`, the compiled statements per dialect.
+    """
+    __slots__ = ('query', 'context', 'compiled')
+
+    def __init__(self, query, compile=True):
+        self.compiled = {}
+        self.context = None
+        query = query._clone()
+        query.session = None
+        if compile:
+            query._execution_options = query._execution_options.union(
+                {'compiled_cache': self.compiled})
+        self.query = query
+
+
+#: values that can be part of an automatic baked query key, they
+#: compare by value or are not expected to change
+_key_types = (basestring, Number, date, datetime, type(None), type,
+              FunctionType, BuiltinFunctionType)
+
+_code_names_cache = {}
+
+
+def _code_names(code):
+    """The names `code` and the code nested in it look up."""
+    rv = _code_names_cache.get(code)
+    if rv is None:
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, CodeType):
+                names.update(_code_names(const))
+        rv = _code_names_cache[code] = tuple(names)
+    return rv
+
+
+def _key_value(value):
+    if isinstance(value, (tuple, frozenset)):
+        for item in value:
+            if not _key_value(item):
+                return False
+        return True
+    return isinstance(value, _key_types)
+
+
+def _code_key(fn):
+    """The code of `fn` with its default arguments, closure and the
+    globals it reads.  `None` if `fn` is not a plain function or one of
+    those values is not a :data:`_key_types` value.
+    """
+    if not isinstance(fn, FunctionType):
+        return None
+    values = list(fn.__defaults__ or ())
+    try:
+        values.extend(cell.cell_contents for cell in fn.__closure__ or ())
+    except ValueError:
+        return None
+    namespace = fn.__globals__
+    for name in _code_names(fn.__code__):
+        # attribute names are in there too, they just do not match
+        if name in namespace:
+            values.append(namespace[name])
+    values = tuple(values)
+    if not _key_value(values):
+        return None
+    return fn.__code__, values
+
+
+def _baked_queries(session):
+    state = getattr(session, '_state', None)
+    if state is not None:
+        return state.baked_queries
+
+
 class BaseQuery(orm.Query):
 
+    #: shape of a query that comes straight from ``Model.query``, only
+    #: those are looked up in the baked query cache
+    _bake_key = None
+    #: the :class:`_BakedEntry` this query was prepared from
+    _baked = None
+
+    def _clone(self):
+        q = orm.Query._clone(self)
+        q.__dict__.pop('_bake_key', None)
+        q.__dict__.pop('_baked', None)
+        return q
+
+    def params(self, *args, **kwargs):
+        q = orm.Query.params(self, *args, **kwargs)
+        q._baked = self._baked
+        return q
+
+    def __iter__(self):
+        rv = self._iter_baked()
+        if getattr(self.session, '_release_connections', False) and \
+                not self._yield_per:
+            rv = list(rv)
+            self.session._release_read_transaction()
+            rv = iter(rv)
+        return rv
+
+    def _iter_baked(self):
+        entry = self._baked
+        if entry is None:
+            return orm.Query.__iter__(self)
+        if entry.context is None:
+            context = self._compile_context()
+            context.statement.use_labels = True
+            # the cached context must not keep the session alive
+            entry.context = copy(context)
+            entry.context.query = entry.context.session = None
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+        context = copy(entry.context)
+        if self._offset != context.statement._offset:
+            # a page of a paginated query.  Limit and offset are coerced to
+            # integers by SQLAlchemy and can not be bind parameters, the
+            # page goes into a copy of the statement instead
+            if context.statement._limit is None:
+                # eager joins wrapped the page in a subquery
+                return orm.Query.__iter__(self)
+            context.statement = context.statement.offset(self._offset)
+        context.query = self
+        context.session = self.session
+        context.attributes = context.attributes.copy()
+        return self._execute_and_instances(context)
+
+    def baked(self, fn, key=None):
+        """Returns ``fn(self)``.  On a query straight from ``Model.query``
+        the built query and its compiled statement are cached per `key`
+        and later calls only bind new parameters.  The default key is the
+        code of `fn`, i.e. its call site, together with its default
+        arguments, closure and the globals it reads.  Only strings,
+        numbers, dates, classes and functions can be part of it, any
+        other value (e.g. a model instance) disables caching unless an
+        explicit `key` is given; cached keys are kept alive by the cache.
+        Values that change between calls should be
+        :func:`~sqlalchemy.sql.expression.bindparam` placeholders filled
+        in with :meth:`params`::
+
+            Todo.query.baked(lambda q: q.filter_by(
+                title=bindparam('title'))).params(title=title).all()
+        """
+        if key is None:
+            key = _code_key(fn)
+            if key is None:
+                return fn(self)
+        return self._bake(key, fn)
+
+    def _bake(self, key, build, compile=True):
+        cache = _baked_queries(self.session)
+        if cache is None or self._bake_key is None:
+            return build(self)
+        key = (self._bake_key, key)
+        entry = cache.get(key)
+        if entry is None:
+            entry = _BakedEntry(build(self), compile)
+            cache.set(key, entry)
+        query = entry.query._clone()
+        query.session = self.session
+        query._polymorphic_adapters = query._polymorphic_adapters.copy()
+        query._baked = entry
+        return query
+
+    def get(self, ident):
+        """Like :meth:`~sqlalchemy.orm.query.Query.get`.  On a query straight
+        from ``Model.query`` the row is loaded with a baked query and, if
+        the model sets ``__cache__``, kept in the model cache.
+        """
+        if self._bake_key is None:
+            return orm.Query.get(self, ident)
+        mapper = self._mapper_zero()
+        if hasattr(ident, '__composite_values__'):
+            ident = ident.__composite_values__()
+        ident = sqlalchemy.util.to_list(ident)
+        if None in ident or len(ident) != len(mapper.primary_key):
+            return orm.Query.get(self, ident)
+        identity_key = mapper.identity_key_from_primary_key(ident)
+        if identity_key in self.session.identity_map:
+            return orm.Query.get(self, ident)
+
+        cache = getattr(self.session, '_state', None)
+        cache = cache and cache.model_cache
+        ttl = cache and cache.ttl(mapper)
+        if ttl:
+            rv = cache.get(self.session, mapper, identity_key)
+            if rv is not None:
+                return rv
+
+        clause, params = mapper._get_clause
+        rv = self._bake('get', lambda q: q.filter(clause)).params(dict(
+            (params[column].key, value)
+            for column, value in zip(mapper.primary_key, ident))).all()
+        if not rv:
+            return None
+        if ttl:
+            cache.set(mapper, rv[0], ttl)
+        return rv[0]
+
+    def _baked_first(self):
+        if self._bake_key is None:
+            return self.first()
+        rv = self._bake('first', lambda q: q.limit(1)).all()
+        if rv:
+            return rv[0]
+
     def get_or_404(self, ident):
         rv = self.get(ident)
         if rv is None:
@@ -253,24 +1458,210 @@ class BaseQuery(orm.Query):
         return rv
 
     def first_or_404(self):
-        rv = self.first()
+        rv = self._baked_first()
         if rv is None:
             abort(404)
         return rv
 
-    def paginate(self, page, endpoint=None, per_page=20, error_out=True):
+    def paginate(self, page, endpoint=None, per_page=20, error_out=True,
+                 count=True, count_ttl=None):
+        """Returns `per_page` items from page `page` as :class:`Pagination`.
+
+        The total is counted with an extra ``COUNT`` query unless `count`
+        is false, then one more row is fetched to find out if there is a
+        next page and the total stays `None`.  `count` can also be a
+        function that returns an estimate of the total for the query,
+        for instance from the planner statistics of the database.  If
+        `count_ttl` is given exact totals are cached for that many
+        seconds.
+        """
         if error_out and page < 1:
             abort(404)
-        items = self.limit(per_page).offset((page - 1) * per_page).all()
+        options = {}
+        if count is not True:
+            options['count'] = count
+        if count_ttl is not None:
+            options['count_ttl'] = count_ttl
+
+        limit = per_page if count is True else per_page + 1
+        offset = (page - 1) * per_page
+        # one entry for all pages, the statements are not kept because
+        # every page compiles to a different one
+        query = self._bake(('page', limit),
+                           lambda q: q.limit(limit).offset(offset), False)
+        if query._offset != offset:
+            baked = query._baked
+            query = query.offset(offset)
+            query._baked = baked
+        items = query.all()
+        if count is True:
+            has_next = None
+        else:
+            has_next = len(items) > per_page
+            items = items[:per_page]
         if not items and page != 1 and error_out:
             abort(404)
 
-        if page == 1 and len(items) < per_page:
-            total = len(items)
+        estimated = False
+        if count is True:
+            if page == 1 and len(items) < per_page:
+                total = len(items)
+            else:
+                total = self._count_total(count_ttl)
+        elif count:
+            total = count(self)
+            estimated = total is not None
         else:
-            total = self.order_by(None).count()
-
-        return Pagination(self, page, endpoint, per_page, total, items)
+            total = None
+
+        return Pagination(self, page, endpoint, per_page, total, items,
+                          has_next, estimated, **options)
+
+    def _count_total(self, ttl=None):
+        if self._bake_key is not None and \
+                _baked_queries(self.session) is not None:
+            count = self._bake('count', lambda q: q.order_by(None).from_self(
+                sqlalchemy.func.count(sqlalchemy.literal_column('*')))).scalar
+            if ttl is None:
+                return count()
+            key = (self.session.get_bind(self._mapper_zero_or_none()),
+                   self._bake_key, 'count')
+        else:
+            query = self.order_by(None)
+            count = query.count
+            if ttl is None:
+                return count()
+            statement = query.statement
+            try:
+                key = (self.session.get_bind(self._mapper_zero_or_none(),
+                                             clause=statement),
+                       str(statement),
+                       tuple(sorted(statement.compile().params.items())))
+                hash(key)
+            except TypeError:
+                return count()
+        total = _count_cache.get(key)
+        if total is None:
+            total = count()
+            _count_cache.set(key, total, ttl)
+        return total
+
+    def stream(self, batch_size=1000, order_columns=None):
+        """Iterates over the results in batches of `batch_size` and
+        expunges every batch from the session once it was yielded, so
+        memory use does not grow with the size of the result.  Instances
+        the session held before and instances with unflushed changes
+        stay in the session.
+
+        A server side cursor is used if the driver supports it, otherwise
+        the rows are fetched with keyset batches over `order_columns`
+        (the primary key by default, see :meth:`seek_paginate`).  Given
+        `order_columns`, or with keyset batches, they replace the ordering
+        of the query; a limit and offset of the query apply to the
+        whole stream in that order.
+        """
+        bind = self.session.get_bind(self._mapper_zero_or_none())
+        if getattr(bind.dialect, 'supports_server_side_cursors', False):
+            query = self
+            if order_columns is not None:
+                query = query._reordered(order_columns)
+            return query._stream_cursor(batch_size)
+        if order_columns is None:
+            order_columns = self._mapper_zero().primary_key
+        return self._stream_keyset(batch_size, order_columns)
+
+    def _stream_cursor(self, batch_size):
+        # instances the session held before are not expunged
+        keep = set(self.session.identity_map.keys())
+        query = self.execution_options(stream_results=True) \
+            .yield_per(batch_size)
+        batch = []
+        for item in query:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                for item in batch:
+                    yield item
+                _expunge_all(self.session, batch, keep)
+                batch = []
+        for item in batch:
+            yield item
+        _expunge_all(self.session, batch, keep)
+
+    def _reordered(self, order_columns):
+        """Replaces the ordering, ``order_by`` refuses to once there is a
+        limit or offset so those are put back afterwards.
+        """
+        return self.limit(None).offset(None).order_by(None) \
+            .order_by(*order_columns).limit(self._limit).offset(self._offset)
+
+    def _stream_keyset(self, batch_size, order_columns):
+        keep = set(self.session.identity_map.keys())
+        columns = _seek_columns(order_columns)
+        remaining = self._limit
+        query = self.limit(None).offset(None).order_by(None).order_by(*[
+            column.desc() if desc else column.asc()
+            for column, desc in columns])
+        size = batch_size if remaining is None else min(batch_size,
+                                                        remaining)
+        # the offset only skips rows before the first batch
+        batch = size and query.offset(self._offset).limit(size).all()
+        while batch:
+            for item in batch:
+                yield item
+            if remaining is not None:
+                remaining -= len(batch)
+                size = min(batch_size, remaining)
+            if len(batch) < batch_size or not size:
+                break
+            values = [_seek_value(batch[-1], column)
+                      for column, desc in columns]
+            _expunge_all(self.session, batch, keep)
+            batch = query.filter(_seek_criterion(columns, values, False)) \
+                .limit(size).all()
+        _expunge_all(self.session, batch or (), keep)
+
+    def seek_paginate(self, order_columns, after=None, before=None,
+                      per_page=20, endpoint=None, error_out=True):
+        """Keyset pagination: instead of an offset the page is located by
+        the values of `order_columns` in the last (`after`) or first
+        (`before`) row of the neighbouring page, so every page costs the
+        same.  `order_columns` replaces the ordering of the query and
+        has to be unique and non-nullable, e.g. ``(Post.created.desc(),
+        Post.id)``.  The cursors are opaque strings taken from the
+        returned :class:`SeekPagination`.
+        """
+        if error_out and per_page < 1:
+            abort(404)
+        columns = _seek_columns(order_columns)
+        cursor = before if before is not None else after
+        query = self.order_by(None)
+        if cursor is not None:
+            try:
+                values = _decode_cursor(cursor)
+            except (TypeError, ValueError):
+                if error_out:
+                    abort(404)
+                raise
+            if len(values) != len(columns):
+                if error_out:
+                    abort(404)
+                raise ValueError('cursor does not match the order columns')
+            query = query.filter(
+                _seek_criterion(columns, values, before is not None))
+        reverse = before is not None
+        query = query.order_by(*[
+            column.desc() if desc != reverse else column.asc()
+            for column, desc in columns])
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if reverse:
+            items.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = after is not None, more
+        return SeekPagination(self, order_columns, endpoint, per_page,
+                              items, has_prev, has_next)
 
 
 class Model(object):
@@ -285,6 +1676,18 @@ class Model(object):
     query = None
 
 
+def _copy_options(options):
+    """Copies a dictionary of engine options and the dictionaries in it
+    (``execution_options``, ``connect_args``) to notice later changes.
+    Other values are shared, pools or SSL contexts can not be copied and
+    compare by identity.
+    """
+    if not isinstance(options, dict):
+        return options
+    return dict((key, dict(value) if isinstance(value, dict) else value)
+                for key, value in options.iteritems())
+
+
 class _EngineConnector(object):
 
     def __init__(self, sa, app, bind=None):
@@ -294,34 +1697,326 @@ class _EngineConnector(object):
         self._connected_for = None
         self._bind = bind
         self._lock = Lock()
+        self._recording = None
+        self._recorder = None
+        self._replicas = []
 
     def get_uri(self):
+        return self.get_bind_config()[0]
+
+    def get_bind_config(self):
+        """Returns the URI of the bind and the engine options of its
+        ``SQLALCHEMY_BINDS`` entry, which is either a URI or a dictionary
+        of the ``'uri'`` and :func:`~sqlalchemy.create_engine` options.
+        """
         if self._bind is None:
-            return self._app.config['SQLALCHEMY_DATABASE_URI']
+            return self._app.config['SQLALCHEMY_DATABASE_URI'], {}
         binds = self._app.config.get('SQLALCHEMY_BINDS') or ()
         assert self._bind in binds, \
             'Bind %r is not specified. Set it in the SQLALCHEMY_BINDS ' \
             'configuration variable' % self._bind
-        return binds[self._bind]
+        config = binds[self._bind]
+        if isinstance(config, basestring):
+            return config, {}
+        assert 'uri' in config, 'Bind %r has no uri' % self._bind
+        options = dict(config)
+        return options.pop('uri'), options
+
+    def get_replica_uris(self):
+        replicas = self._app.config['SQLALCHEMY_REPLICAS'] or {}
+        return tuple(replicas.get(self._bind) or ())
 
     def get_engine(self):
         with self._lock:
-            uri = self.get_uri()
+            uri, bind_options = self.get_bind_config()
             echo = self._app.config['SQLALCHEMY_ECHO']
-            if (uri, echo) == self._connected_for:
+            replica_uris = self.get_replica_uris()
+            connect_for = (uri, echo, replica_uris, bind_options)
+            if connect_for == self._connected_for:
                 return self._engine
-            info = make_url(uri)
-            options = {'convert_unicode': True}
-            self._sa.apply_pool_defaults(self._app, options)
-            #self._sa.apply_driver_hacks(self._app, info, options)
-            if _record_queries(self._app):
-                options['proxy'] = _ConnectionDebugProxy(self._app.import_name)
-            if echo:
-                options['echo'] = True
-            self._engine = rv = sqlalchemy.create_engine(info, **options)
-            self._connected_for = (uri, echo)
+            self._engine = rv = self._create_engine(uri, echo, bind_options)
+            self._replicas = [
+                self._create_engine(replica_uri, echo, bind_options)
+                for replica_uri in replica_uris]
+            self._connected_for = (uri, echo, replica_uris,
+                                   _copy_options(bind_options))
+            self._recorder = None
+            self._apply_recording()
             return rv
 
+    def get_replicas(self):
+        """Returns the engines of the ``SQLALCHEMY_REPLICAS`` of the bind,
+        they are created together with the primary engine.
+        """
+        self.get_engine()
+        return list(self._replicas)
+
+    def _create_engine(self, uri, echo, bind_options):
+        """Creates an engine with ``SQLALCHEMY_ENGINE_OPTIONS``, the pool
+        settings and the options of the bind, in that order.  Execution
+        options are merged key by key.
+        """
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        options.update(self._app.config['SQLALCHEMY_ENGINE_OPTIONS'] or {})
+        self._sa.apply_pool_defaults(self._app, options)
+        #self._sa.apply_driver_hacks(self._app, info, options)
+        if echo:
+            options['echo'] = True
+        execution_options = dict(options.get('execution_options') or {})
+        execution_options.update(bind_options.get('execution_options') or {})
+        options.update(bind_options)
+        if execution_options:
+            options['execution_options'] = execution_options
+        # neither is a create_engine option before SQLAlchemy 1.2/1.3
+        pre_ping = options.pop('pool_pre_ping', False)
+        if options.pop('pool_use_lifo', False):
+            poolclass = options.get('poolclass') or \
+                info.get_dialect().get_pool_class(info)
+            if poolclass is QueuePool:
+                options['poolclass'] = _LIFOQueuePool
+        engine = sqlalchemy.create_engine(info, **options)
+        if pre_ping:
+            listen(engine, 'checkout', _ping_connection)
+        if self._app.config['SQLALCHEMY_POOL_METRICS']:
+            engine.pool.__class__ = _metered_pool_class(engine.pool.__class__)
+            _HoldTimer(engine.pool.metrics).register(engine)
+        return engine
+
+    def dispose(self):
+        """Closes the idle pooled connections of the engines, they connect
+        again on demand.
+        """
+        with self._lock:
+            for engine in self._engines():
+                engine.dispose()
+
+    def after_fork(self, orphaned_pools):
+        """Gives the engines new pools without closing the inherited ones,
+        their connections are still in use by the parent process.
+        """
+        self._lock = Lock()
+        for engine in self._engines():
+            orphaned_pools.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+
+    def _engines(self):
+        if self._engine is None:
+            return []
+        return [self._engine] + self._replicas
+
+    def get_pool_metrics(self):
+        """Returns the connection counts of the pool and, with
+        ``SQLALCHEMY_POOL_METRICS``, the checkout wait, connect time and
+        hold time histograms.  The replicas are reported under
+        ``'replicas'``.
+        """
+        engine = self.get_engine()
+        rv = _pool_metrics(engine.pool)
+        if self._replicas:
+            rv['replicas'] = [_pool_metrics(replica.pool)
+                              for replica in self._replicas]
+        return rv
+
+    def set_recording(self, enabled):
+        """Turns query recording on or off for the live engine.  `None`
+        goes back to what the configuration says.
+        """
+        with self._lock:
+            self._recording = enabled
+            if self._engine is not None:
+                self._apply_recording()
+
+    def _apply_recording(self):
+        config = self._app.config
+        record = self._recording
+        if record is None:
+            record = _record_queries(self._app)
+        stats = config['SQLALCHEMY_QUERY_STATS'] and _query_stats or None
+        nplusone = config['SQLALCHEMY_NPLUSONE_THRESHOLD']
+        if record or stats is not None or nplusone is not None:
+            if self._recorder is None:
+                self._recorder = _QueryRecorder(
+                    self._app.import_name,
+                    config['SQLALCHEMY_RECORD_QUERIES_SAMPLE_RATE'],
+                    config['SQLALCHEMY_RECORD_QUERIES_LIMIT'],
+                    config['SQLALCHEMY_RECORD_QUERIES_THRESHOLD'])
+            self._recorder.record = record
+            self._recorder.stats = stats
+            self._recorder.nplusone = nplusone
+            self._recorder.nplusone_raise = config['TESTING'] and \
+                config['SQLALCHEMY_NPLUSONE_RAISE']
+            for engine in self._engines():
+                self._recorder.attach(engine)
+        elif self._recorder is not None:
+            for engine in self._engines():
+                self._recorder.detach(engine)
+
+
+class _LIFOQueue(Queue):
+
+    def _get(self):
+        return self.queue.pop()
+
+
+class _LIFOQueuePool(QueuePool):
+    """Hands out the most recently returned connection first, so that idle
+    connections beyond the load can time out on the server.
+    """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._pool = _LIFOQueue(self._pool.maxsize)
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Checks a connection on checkout, the pool replaces it if it is
+    gone.
+    """
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        raise sqlalchemy.exc.DisconnectionError()
+
+
+class _Histogram(object):
+    """Counts values (seconds) into buckets with the upper `bounds`."""
+
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._lock = Lock()
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        with self._lock:
+            self.buckets[bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self._lock:
+            return {'count': self.count, 'total': self.total,
+                    'max': self.max,
+                    'mean': self.count and self.total / self.count or 0.0,
+                    'buckets': list(zip(self.bounds + (float('inf'),),
+                                        self.buckets))}
+
+
+class _PoolMetrics(object):
+
+    def __init__(self):
+        self.checkout = _Histogram()
+        self.connect = _Histogram()
+        self.hold = _Histogram()
+        self.timeouts = 0
+
+
+class _HoldTimer(object):
+    """Measures how long connections stay checked out of the pool, into
+    the metrics and per app context (see :func:`get_pool_hold_time`).
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def register(self, engine):
+        listen(engine, 'checkout', self.checkout)
+        listen(engine, 'checkin', self.checkin)
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['squll_checkout'] = _timer()
+
+    def checkin(self, dbapi_connection, connection_record):
+        start = connection_record.info.pop('squll_checkout', None)
+        if start is None:
+            return
+        held = _timer() - start
+        self.metrics.hold.add(held)
+        ctx = connection_stack.top
+        if ctx is not None:
+            ctx.sqlalchemy_pool_hold_time = \
+                getattr(ctx, 'sqlalchemy_pool_hold_time', 0.0) + held
+
+
+def _metered_pool_class(cls):
+    """Returns a subclass of the pool class `cls` that times checkouts and
+    new connections.  Pools recreated by ``dispose`` keep the class and
+    with it the metrics.
+    """
+    metrics = _PoolMetrics()
+
+    def _do_get(self):
+        start = _timer()
+        try:
+            return cls._do_get(self)
+        except sqlalchemy.exc.TimeoutError:
+            metrics.timeouts += 1
+            raise
+        finally:
+            metrics.checkout.add(_timer() - start)
+
+    def _create_connection(self):
+        start = _timer()
+        try:
+            return cls._create_connection(self)
+        finally:
+            metrics.connect.add(_timer() - start)
+
+    return type('Metered' + cls.__name__, (cls,), {
+        '_do_get': _do_get, '_create_connection': _create_connection,
+        'metrics': metrics})
+
+
+def _pool_metrics(pool):
+    rv = {'pool': type(pool).__name__}
+    for key in 'size', 'checkedin', 'checkedout', 'overflow':
+        method = getattr(pool, key, None)
+        if method is not None:
+            rv[key] = method()
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        rv['checkout_wait'] = metrics.checkout.snapshot()
+        rv['connect'] = metrics.connect.snapshot()
+        rv['hold'] = metrics.hold.snapshot()
+        rv['timeouts'] = metrics.timeouts
+    return rv
+
+
+class _ReplicaSet(object):
+    """The replica engines of a bind.  ``round_robin`` takes them in turn,
+    ``least_connections`` takes the one with the fewest checked out
+    connections, starting the search at the next one in turn.
+    """
+
+    def __init__(self, engines, strategy='round_robin'):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('unknown replica strategy %r' % strategy)
+        self.engines = engines
+        self.strategy = strategy
+        self._turn = itertools.count()
+
+    def choose(self):
+        engines = self.engines
+        start = next(self._turn) % len(engines)
+        if self.strategy == 'round_robin':
+            return engines[start]
+        return min(engines[start:] + engines[:start], key=_checked_out)
+
+
+def _checked_out(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout is not None else 0
+
 
 def _defines_primary_key(d):
     """Figures out if the given dictonary defines a primary key column."""
@@ -329,22 +2024,58 @@ def _defines_primary_key(d):
                if isinstance(v, sqlalchemy.Column))
 
 
+_mappers_generation = 0
+_mapper_events_registered = False
+
+
+def _register_mapper_events():
+    global _mapper_events_registered
+    if not _mapper_events_registered:
+        _mapper_events_registered = True
+        listen(orm.mapper, 'instrument_class', _new_mapper)
+
+
+def _new_mapper(mapper, class_):
+    global _mappers_generation
+    _mappers_generation += 1
+
+
 class _QueryProperty(object):
-    """"""
+    """Builds ``Model.query`` by cloning a query prepared once per class.
+    Prepared queries are dropped whenever a new mapper is created, query
+    classes with their own ``__init__`` are always constructed.
+    """
     def __init__(self, sa):
         self.sa = sa
+        self._queries = {}
 
     def __get__(self, obj, type):
-        try:
-            mapper = orm.class_mapper(type)
-            if mapper:
-                return type.query_class(mapper, session=self.sa.session())
-        except UnmappedClassError:
-            return None
+        entry = self._queries.get(type)
+        if entry is None or entry[0] != _mappers_generation:
+            # nothing was prepared before the first miss, so mappers
+            # created until then need not be counted
+            _register_mapper_events()
+            generation = _mappers_generation
+            try:
+                mapper = orm.class_mapper(type)
+            except UnmappedClassError:
+                return None
+            if type.query_class.__init__ != orm.Query.__init__:
+                return type.query_class(mapper,
+                                        session=self.sa.session.registry())
+            entry = self._queries[type] = (generation,
+                                           type.query_class(mapper))
+        query = entry[1]._clone()
+        query.session = self.sa.session.registry()
+        query._polymorphic_adapters = query._polymorphic_adapters.copy()
+        query._bake_key = (type, entry[0])
+        return query
 
 
 class Squll(object):
 
+    Query = BaseQuery
+
     def __init__(self, app=None,
                  use_native_unicode=True,
                  session_options=None):
@@ -358,6 +2089,7 @@ class Squll(object):
         self.session = self.create_scoped_session(session_options)
         self.Model = self.make_declarative_base()
         self._engine_lock = Lock()
+        self._table_index = (None, {})
 
         if app is not None:
             self.app = app
@@ -365,10 +2097,19 @@ class Squll(object):
         else:
             self.app = None
 
-        _include_sqlalchemy(self)
-        _MapperSignalEvents(self.mapper).register()
-        _SessionSignalEvents().register()
-        self.Query = BaseQuery
+    def __getattr__(self, name):
+        # SQLAlchemy names are resolved on first use and then stored on
+        # the instance.  Note: Table does not attempt to be a SQLAlchemy
+        # Table class.
+        if name == 'Table':
+            value = _make_table(self)
+        else:
+            try:
+                value = _get_sqlalchemy_namespace()[name]
+            except KeyError:
+                raise AttributeError(name)
+        setattr(self, name, value)
+        return value
 
     @property
     def metadata(self):
@@ -390,15 +2131,45 @@ class Squll(object):
         return base
 
     def init_app(self, app):
+        _register_signal_events()
         app.config.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
         app.config.setdefault('SQLALCHEMY_BINDS', None)
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', None)
         app.config.setdefault('SQLALCHEMY_NATIVE_UNICODE', None)
         app.config.setdefault('SQLALCHEMY_ECHO', False)
         app.config.setdefault('SQLALCHEMY_RECORD_QUERIES', None)
+        app.config.setdefault('SQLALCHEMY_RECORD_QUERIES_SAMPLE_RATE', 1.0)
+        app.config.setdefault('SQLALCHEMY_RECORD_QUERIES_LIMIT', None)
+        app.config.setdefault('SQLALCHEMY_RECORD_QUERIES_THRESHOLD', None)
+        app.config.setdefault('SQLALCHEMY_QUERY_STATS', False)
+        app.config.setdefault('SQLALCHEMY_NPLUSONE_THRESHOLD', None)
+        app.config.setdefault('SQLALCHEMY_NPLUSONE_RAISE', False)
         app.config.setdefault('SQLALCHEMY_POOL_SIZE', None)
         app.config.setdefault('SQLALCHEMY_POOL_TIMEOUT', None)
         app.config.setdefault('SQLALCHEMY_POOL_RECYCLE', None)
+        app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', None)
+        app.config.setdefault('SQLALCHEMY_POOL_USE_LIFO', None)
+        app.config.setdefault('SQLALCHEMY_POOL_METRICS', False)
+        app.config.setdefault('SQLALCHEMY_RELEASE_CONNECTIONS', False)
         app.config.setdefault('SQLALCHEMY_COMMIT_ON_TEARDOWN', False)
+        app.config.setdefault('SQLALCHEMY_BULK_CHUNK_SIZE', 1000)
+        app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', None)
+        app.config.setdefault('SQLALCHEMY_COMPACT_MODEL_CHANGES', False)
+        app.config.setdefault('SQLALCHEMY_COMMIT_DISPATCH', 'sync')
+        app.config.setdefault('SQLALCHEMY_DISPATCH_WORKERS', 2)
+        app.config.setdefault('SQLALCHEMY_DISPATCH_QUEUE_SIZE', 1000)
+        app.config.setdefault('SQLALCHEMY_DISPATCH_TIMEOUT', 1.0)
+        app.config.setdefault('SQLALCHEMY_PARALLEL_DDL', False)
+        app.config.setdefault('SQLALCHEMY_DDL_WORKERS', None)
+        app.config.setdefault('SQLALCHEMY_REFLECTION_CACHE', None)
+        app.config.setdefault('SQLALCHEMY_BAKED_QUERIES_SIZE', 500)
+        app.config.setdefault('SQLALCHEMY_CACHE_BACKEND', None)
+        app.config.setdefault('SQLALCHEMY_CACHE_SIZE', 1000)
+        app.config.setdefault('SQLALCHEMY_CACHE_TTL', 300)
+        app.config.setdefault('SQLALCHEMY_REPLICAS', None)
+        app.config.setdefault('SQLALCHEMY_REPLICA_STRATEGY', 'round_robin')
+        app.config.setdefault('SQLALCHEMY_REPLICA_PIN_WINDOW', 1.0)
 
         if not hasattr(app, 'extensions'):
             app.extensions = {}
@@ -408,6 +2179,8 @@ class Squll(object):
 
         @teardown
         def shutdown_session(response_or_exc):
+            if not self.session.registry.has():
+                return response_or_exc
             if app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN']:
                 if response_or_exc is None:
                     self.session.commit()
@@ -415,6 +2188,9 @@ class Squll(object):
             return response_or_exc
 
     def apply_pool_defaults(self, app, options):
+        """Sets the pool options of the configuration.  Pool options of a
+        single bind go into its ``SQLALCHEMY_BINDS`` entry.
+        """
         def _setdefault(optionkey, configkey):
             value = app.config[configkey]
             if value is not None:
@@ -422,22 +2198,149 @@ class Squll(object):
         _setdefault('pool_size', 'SQLALCHEMY_POOL_SIZE')
         _setdefault('pool_timeout', 'SQLALCHEMY_POOL_TIMEOUT')
         _setdefault('pool_recycle', 'SQLALCHEMY_POOL_RECYCLE')
+        _setdefault('max_overflow', 'SQLALCHEMY_MAX_OVERFLOW')
+        _setdefault('pool_pre_ping', 'SQLALCHEMY_POOL_PRE_PING')
+        _setdefault('pool_use_lifo', 'SQLALCHEMY_POOL_USE_LIFO')
 
     @property
     def engine(self):
-        return self.get_engine(self.get_app())
+        app = self.get_app()
+        self._check_pid(get_state(app))
+        return self.get_engine(app)
 
     def make_connector(self, app, bind=None):
         return _EngineConnector(self, app, bind)
 
     def get_engine(self, app, bind=None):
+        """Returns the engine for a bind.  Once an engine was created it
+        is served from the per-app registry without taking any locks;
+        configuration changes are only picked up after
+        :meth:`invalidate_engines` was called.
+        """
+        engine = get_state(app).engines.get(bind)
+        if engine is not None:
+            return engine
+        self._check_pid(get_state(app))
+        return self._connect(app, bind)
+
+    def _check_pid(self, state):
+        """Calls :meth:`_after_fork` if the pools of `state` were created
+        in another process.  This happens when a session is created,
+        for :attr:`engine`, :meth:`get_binds` and when an engine is
+        missing from the registry, not on every engine lookup.
+        """
+        if state.pid != os.getpid():
+            self._after_fork(state)
+
+    def _after_fork(self, state):
+        """Resets the pools, once per process, when the app is used in a
+        forked process.  Configuration, engines and metadata are kept.
+        """
+        with self._engine_lock:
+            pid = os.getpid()
+            if state.pid == pid:
+                return
+            for connector in state.connectors.values():
+                connector.after_fork(state.orphaned_pools)
+            # the worker threads were not forked along
+            state.dispatcher = None
+            state.pid = pid
+
+    def dispose_all(self, app=None):
+        """Closes the idle pooled connections of all engines and replicas
+        of the app.  The engines stay usable and connect again on demand.
+        """
+        for connector in get_state(self.get_app(app)).connectors.values():
+            connector.dispose()
+
+    def before_fork(self, app=None):
+        """To be called in the parent process right before workers are
+        forked (e.g. from gunicorn's ``pre_fork`` hook).  Sends pending
+        async commit signals and disposes all engines so that the workers
+        do not inherit connections.
+        """
+        self.flush_commit_dispatch(app)
+        self.dispose_all(app)
+
+    def get_last_write(self, app, bind=None):
+        """Returns when a write to `bind` was last committed, reads stay
+        on the primary for ``SQLALCHEMY_REPLICA_PIN_WINDOW`` seconds after
+        that.  The time is kept per app and bind so that the pin outlives
+        the request, override this and :meth:`set_last_write` to pin per
+        client instead (e.g. with a cookie).
+        """
+        return get_state(app).last_writes.get(bind)
+
+    def set_last_write(self, app, bind, timestamp):
+        get_state(app).last_writes[bind] = timestamp
+
+    def get_replica(self, app, bind=None):
+        """Returns a replica engine of a bind chosen by
+        ``SQLALCHEMY_REPLICA_STRATEGY`` (``'round_robin'`` or
+        ``'least_connections'``), `None` if the bind has no replicas.
+        """
+        replicas = get_state(app).replicas
+        if bind not in replicas:
+            self._connect(app, bind)
+            replicas = get_state(app).replicas
+        replicas = replicas.get(bind)
+        if replicas is not None:
+            return replicas.choose()
+
+    def _connect(self, app, bind):
         with self._engine_lock:
             state = get_state(app)
             connector = state.connectors.get(bind)
             if connector is None:
                 connector = self.make_connector(app, bind)
                 state.connectors[bind] = connector
-            return connector.get_engine()
+            engine = connector.get_engine()
+            engines = connector.get_replicas()
+            replicas = dict(state.replicas)
+            replicas[bind] = engines and _ReplicaSet(
+                engines, app.config['SQLALCHEMY_REPLICA_STRATEGY']) or None
+            state.replicas = replicas
+            engines = dict(state.engines)
+            engines[bind] = engine
+            state.engines = engines
+            return engine
+
+    def invalidate_engines(self, app=None, bind='__all__'):
+        """Drops engines from the registry so that the next lookup goes
+        through the connector again and notices configuration changes.
+        """
+        app = self.get_app(app)
+        with self._engine_lock:
+            state = get_state(app)
+            if bind == '__all__':
+                state.engines = {}
+                state.replicas = {}
+            else:
+                engines = dict(state.engines)
+                engines.pop(bind, None)
+                state.engines = engines
+                replicas = dict(state.replicas)
+                replicas.pop(bind, None)
+                state.replicas = replicas
+            state.binds = None
+            state.mapper_binds = {}
+
+    def enable_query_recording(self, app=None, bind='__all__'):
+        """Starts recording queries on the engines of the given binds.
+        The engines and their pools are kept, so this can be used on a
+        running application.
+        """
+        self._set_query_recording(app, bind, True)
+
+    def disable_query_recording(self, app=None, bind='__all__'):
+        """Stops recording queries on the engines of the given binds."""
+        self._set_query_recording(app, bind, False)
+
+    def _set_query_recording(self, app, bind, enabled):
+        app = self.get_app(app)
+        for bind in self._get_bind_keys(app, bind):
+            self.get_engine(app, bind)
+            get_state(app).connectors[bind].set_recording(enabled)
 
     def get_app(self, reference_app=None):
         if reference_app is not None:
@@ -451,50 +2354,251 @@ class Squll(object):
                            'instance and no application bound '
                            'to current context')
 
+    def _get_table_index(self):
+        """Returns a bind -> tables index of the metadata.  The index is
+        rebuilt whenever the number of tables in the metadata changes.
+        """
+        tables = self.Model.metadata.tables
+        count, index = self._table_index
+        if count != len(tables):
+            index = {}
+            for table in tables.itervalues():
+                index.setdefault(table.info.get('bind_key'), []).append(table)
+            self._table_index = (len(tables), index)
+        return index
+
     def get_tables_for_bind(self, bind=None):
         """Returns a list of all tables relevant for a bind."""
-        result = []
-        for table in self.Model.metadata.tables.itervalues():
-            if table.info.get('bind_key') == bind:
-                result.append(table)
-        return result
+        return list(self._get_table_index().get(bind, ()))
 
     def get_binds(self, app=None):
         """Returns a dictionary with a table->engine mapping.
         This is suitable for use of sessionmaker(binds=db.get_binds(app)).
+
+        The mapping is computed once per app and shared; it is rebuilt when
+        tables are added to the metadata or ``SQLALCHEMY_BINDS`` changes,
+        so it must not be modified by the caller.
         """
         app = self.get_app(app)
-        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+        state = get_state(app)
+        self._check_pid(state)
+        config_binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        tables = len(self.Model.metadata.tables)
+        cached = state.binds
+        if cached is not None:
+            (cached_tables, cached_binds), retval = cached
+            if cached_tables == tables and cached_binds == config_binds:
+                return retval
+            if cached_binds != config_binds:
+                self.invalidate_engines(app)
         retval = {}
-        for bind in binds:
+        for bind in [None] + list(config_binds):
             engine = self.get_engine(app, bind)
-            tables = self.get_tables_for_bind(bind)
-            retval.update(dict((table, engine) for table in tables))
+            for table in self._get_table_index().get(bind, ()):
+                retval[table] = engine
+        state.binds = ((tables, dict(
+            (bind, _copy_options(config))
+            for bind, config in config_binds.iteritems())), retval)
         return retval
 
-    def _execute_for_all_tables(self, app, bind, operation):
+    def get_pool_metrics(self, app=None, bind='__all__'):
+        """Returns the pool metrics of the given binds keyed by bind, see
+        ``_EngineConnector.get_pool_metrics``.
+        """
         app = self.get_app(app)
+        rv = {}
+        for bind in self._get_bind_keys(app, bind):
+            self.get_engine(app, bind)
+            rv[bind] = get_state(app).connectors[bind].get_pool_metrics()
+        return rv
 
+    def _get_bind_keys(self, app, bind):
         if bind == '__all__':
-            binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
-        elif isinstance(bind, basestring):
-            binds = [bind]
-        else:
-            binds = bind
-
-        for bind in binds:
-            tables = self.get_tables_for_bind(bind)
-            op = getattr(self.Model.metadata, operation)
-            op(bind=self.get_engine(app, bind), tables=tables)
+            return [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+        elif bind is None or isinstance(bind, basestring):
+            return [bind]
+        return bind
+
+    def bulk_insert(self, model, rows, chunk_size=None, app=None,
+                    summarize=False):
+        """Inserts `rows`, dictionaries keyed by attribute or column name,
+        into the table of `model` with one executemany per chunk.  See
+        :meth:`_bulk_execute` for how chunks and signals are handled.
+        """
+        return self._bulk_execute(model, rows, 'insert', chunk_size, app,
+                                  summarize)
 
-    def create_all(self, bind='__all__', app=None):
-        self._execute_for_all_tables(app, bind, 'create_all')
+    def bulk_update(self, model, rows, chunk_size=None, app=None,
+                    summarize=False):
+        """Updates the rows identified by the primary key values in
+        `rows` with the other values in them.
+        """
+        return self._bulk_execute(model, rows, 'update', chunk_size, app,
+                                  summarize)
 
-    def drop_all(self, bind='__all__', app=None):
-        self._execute_for_all_tables(app, bind, 'drop_all')
+    def bulk_upsert(self, model, rows, chunk_size=None, app=None,
+                    summarize=False):
+        """Updates the rows that exist already and inserts the others.
+        Every chunk costs one extra SELECT of the primary keys.
+        """
+        return self._bulk_execute(model, rows, 'upsert', chunk_size, app,
+                                  summarize)
+
+    def _bulk_execute(self, model, rows, operation, chunk_size, app,
+                      summarize):
+        """Executes a bulk operation without the session.  Every chunk of
+        ``SQLALCHEMY_BULK_CHUNK_SIZE`` rows runs in its own transaction
+        on the bind of the model and sends one `before_models_committed`
+        and one `models_committed` signal.  The changes are ``(row,
+        operation)`` tuples of the given dictionaries (``(model, pk,
+        operation)`` with ``SQLALCHEMY_COMPACT_MODEL_CHANGES``), or with
+        `summarize` a single ``(model, operation)`` (``(model, None,
+        operation)``) tuple per chunk and operation.  Returns the number
+        of rows.
+        """
+        app = self.get_app(app)
+        mapper = orm.class_mapper(model)
+        table = mapper.local_table
+        engine = self.get_engine(app, table.info.get('bind_key'))
+        if chunk_size is None:
+            chunk_size = app.config['SQLALCHEMY_BULK_CHUNK_SIZE']
+        columns = _bulk_columns(mapper, table)
+        pk = mapper.primary_key
+        cache = get_state(app).model_cache
+        if cache is not None and not cache.ttl(mapper):
+            cache = None
+
+        rows = list(rows)
+        for offset in xrange(0, len(rows), chunk_size):
+            chunk = rows[offset:offset + chunk_size]
+            params = [dict((columns[key].key, value)
+                           for key, value in row.iteritems())
+                      for row in chunk]
+            conn = engine.connect()
+            try:
+                trans = conn.begin()
+                try:
+                    if operation == 'upsert':
+                        existing = _bulk_existing(conn, pk, params)
+                        ops = [tuple(p[c.key] for c in pk) in existing and
+                               'update' or 'insert' for p in params]
+                    else:
+                        ops = [operation] * len(chunk)
+                    inserts = [p for p, op in zip(params, ops)
+                               if op == 'insert']
+                    updates = [p for p, op in zip(params, ops)
+                               if op == 'update']
+                    if inserts:
+                        _bulk_insert(conn, table, inserts)
+                    if updates:
+                        _bulk_update(conn, table, pk, updates)
+                    changes = None
+                    if _track_modifications(app):
+                        changes = _bulk_changes(
+                            model, pk, chunk, params, ops, summarize,
+                            app.config['SQLALCHEMY_COMPACT_MODEL_CHANGES'])
+                    if changes:
+                        before_models_committed.send(app, changes=changes)
+                    trans.commit()
+                except Exception:
+                    trans.rollback()
+                    raise
+            finally:
+                conn.close()
+            if changes:
+                models_committed.send(app, changes=changes)
+            if cache is not None:
+                cache.invalidate(app, _bulk_changes(
+                    model, pk, chunk, params, ops, summarize, True))
+        return len(rows)
+
+    def flush_commit_dispatch(self, app=None, timeout=None):
+        """Waits until `models_committed` was sent for all changes that
+        were queued with ``SQLALCHEMY_COMMIT_DISPATCH = 'async'``.
+        Returns `False` if the timeout expired first.
+        """
+        dispatcher = get_state(self.get_app(app)).dispatcher
+        if dispatcher is None:
+            return True
+        return dispatcher.flush(timeout)
+
+    def get_baked_query_stats(self, app=None):
+        """Returns size, capacity, hits, misses and evictions of the baked
+        query cache of the app, `None` if ``SQLALCHEMY_BAKED_QUERIES_SIZE``
+        disables it.
+        """
+        cache = get_state(self.get_app(app)).baked_queries
+        if cache is not None:
+            return cache.stats()
+
+    def get_model_cache_stats(self, app=None):
+        """Returns hits, misses, invalidations and the hit ratio of the
+        model cache of the app, `None` if it is disabled because
+        ``SQLALCHEMY_TRACK_MODIFICATIONS`` is false.
+        """
+        cache = get_state(self.get_app(app)).model_cache
+        if cache is not None:
+            return cache.stats()
+
+    def _execute_for_all_tables(self, app, bind, operation, parallel=None):
+        """Runs `operation` for the tables of every bind and returns an
+        ordered bind -> seconds timing report.  With `parallel` (default
+        ``SQLALCHEMY_PARALLEL_DDL``) the binds are handled concurrently
+        by up to ``SQLALCHEMY_DDL_WORKERS`` threads; binds with a thread
+        local pool (in-memory SQLite) always run in the calling thread.
+        """
+        app = self.get_app(app)
+        if parallel is None:
+            parallel = app.config['SQLALCHEMY_PARALLEL_DDL']
+        # engines are created here so that no worker has to
+        jobs = [(bind, self.get_engine(app, bind))
+                for bind in self._get_bind_keys(app, bind)]
+
+        def execute(bind, engine):
+            if operation == 'reflect':
+                return self._reflect_bind(
+                    engine, app.config['SQLALCHEMY_REFLECTION_CACHE'])
+            op = getattr(self.Model.metadata, operation)
+            op(bind=engine, tables=self.get_tables_for_bind(bind))
 
-    def reflect(self, bind='__all__', app=None):
-        self._execute_for_all_tables(app, bind, 'reflect')
+        if parallel:
+            results = _run_per_bind(jobs, execute,
+                                    app.config['SQLALCHEMY_DDL_WORKERS'])
+        else:
+            results = [_timed(execute, bind, engine) for bind, engine in jobs]
+
+        if operation == 'reflect':
+            for (bind, engine), (elapsed, metadata) in zip(jobs, results):
+                self._merge_reflected(bind, metadata)
+        return OrderedDict((bind, elapsed) for (bind, engine), (elapsed, rv)
+                           in zip(jobs, results))
+
+    def _reflect_bind(self, engine, cache_dir=None):
+        # reflection goes into a metadata of its own so that binds can be
+        # reflected concurrently, the tables are merged afterwards
+        if cache_dir is not None:
+            metadata = _reflect_cached(engine, cache_dir)
+            if metadata is not None:
+                return metadata
+        metadata = sqlalchemy.MetaData()
+        metadata.reflect(bind=engine)
+        return metadata
+
+    def _merge_reflected(self, bind, metadata):
+        for table in metadata.sorted_tables:
+            if table.key not in self.Model.metadata.tables:
+                table = table.tometadata(self.Model.metadata)
+                table.info['bind_key'] = bind
+
+    def create_all(self, bind='__all__', app=None, parallel=None):
+        return self._execute_for_all_tables(app, bind, 'create_all',
+                                            parallel)
+
+    def drop_all(self, bind='__all__', app=None, parallel=None):
+        return self._execute_for_all_tables(app, bind, 'drop_all', parallel)
+
+    def reflect(self, bind='__all__', app=None, parallel=None):
+        return self._execute_for_all_tables(app, bind, 'reflect', parallel)
 
     def __repr__(self):
         app = None
@@ -514,7 +2618,26 @@ _timer = time
 
 
 def get_debug_queries():
-    return getattr(connection_stack.top, 'sqlalchemy_queries', [])
+    return list(getattr(connection_stack.top, 'sqlalchemy_queries', ()))
+
+
+def get_pool_hold_time():
+    """Returns the seconds connections were checked out of the pool in the
+    current app context so far, with ``SQLALCHEMY_POOL_METRICS`` enabled.
+    """
+    return getattr(connection_stack.top, 'sqlalchemy_pool_hold_time', 0.0)
+
+
+def get_query_stats():
+    """Returns a snapshot of the process wide statement statistics that
+    are collected for apps with ``SQLALCHEMY_QUERY_STATS`` enabled, the
+    most expensive statements first.
+    """
+    return _query_stats.snapshot()
+
+
+def reset_query_stats():
+    _query_stats.reset()
 
 
 def _record_queries(app):
@@ -526,27 +2649,105 @@ def _record_queries(app):
     return bool(app.config.get('TESTING'))
 
 
-class _ConnectionDebugProxy(ConnectionProxy):
-    """Helps debugging the database."""
+class _QueryRecorder(object):
+    """Helps debugging the database by recording the statements of an
+    engine into the current app context.
 
-    def __init__(self, import_name):
-        self.app_package = import_name
+    Only a `sample_rate` fraction of the statements is recorded,
+    statements faster than `threshold` seconds are dropped and at most
+    `limit` statements are kept per context (the oldest ones are
+    discarded).  If `stats` is set every statement is also added to
+    that :class:`_QueryStatistics`, with the calling context of the
+    sampled ones.  If `nplusone` is set, a SELECT that runs more often
+    than that in one app context is reported.
+    """
 
-    def cursor_execute(self, execute, cursor, statement, parameters,
-                       context, executemany):
-        start = _timer()
-        try:
-            return execute(cursor, statement, parameters, context)
-        finally:
-            ctx = connection_stack.top
-            if ctx is not None:
+    def __init__(self, import_name, sample_rate=1.0, limit=None,
+                 threshold=None):
+        self.app_package = import_name
+        self.sample_rate = sample_rate
+        self.limit = limit
+        self.threshold = threshold
+        self.record = True
+        self.stats = None
+        self.nplusone = None
+        self.nplusone_raise = False
+        self.enabled = False
+        self._engines = set()
+
+    def attach(self, engine):
+        if engine not in self._engines:
+            listen(engine, 'before_cursor_execute',
+                   self.before_cursor_execute)
+            listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+            self._engines.add(engine)
+        self.enabled = True
+
+    def detach(self, engine):
+        # where listeners cannot be removed they stay attached and
+        # return right away
+        self.enabled = False
+        if engine in self._engines and _removable_listeners:
+            remove(engine, 'before_cursor_execute',
+                   self.before_cursor_execute)
+            remove(engine, 'after_cursor_execute', self.after_cursor_execute)
+            self._engines.discard(engine)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if not self.enabled or context is None:
+            return
+        sampled = self.sample_rate >= 1 or random() < self.sample_rate
+        if sampled or self.stats is not None or self.nplusone is not None:
+            context._squll_query = (_timer(), sampled)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        query = getattr(context, '_squll_query', None)
+        if query is None:
+            return
+        end = _timer()
+        start, sampled = query
+        frame = None
+        ctx = connection_stack.top
+        if sampled:
+            keep = self.record and ctx is not None and (
+                self.threshold is None or end - start >= self.threshold)
+            if keep or self.stats is not None:
+                frame = _calling_frame(self.app_package)
+            if keep:
                 queries = getattr(ctx, 'sqlalchemy_queries', None)
                 if queries is None:
-                    queries = []
+                    queries = deque(maxlen=self.limit)
                     setattr(ctx, 'sqlalchemy_queries', queries)
                 queries.append(_DebugQueryTuple((
-                    statement, parameters, start, _timer(),
-                    _calling_context(self.app_package))))
+                    statement, parameters, start, end, frame)))
+        if self.stats is not None:
+            self.stats.add(statement, end - start, cursor.rowcount, frame)
+        if self.nplusone is not None and ctx is not None and \
+                statement.lstrip()[:6].upper() == 'SELECT':
+            self._count_select(ctx, statement, frame)
+
+    def _count_select(self, ctx, statement, frame):
+        key = _normalized_statement(statement)
+        counts = getattr(ctx, 'sqlalchemy_statement_counts', None)
+        if counts is None:
+            counts = {}
+            setattr(ctx, 'sqlalchemy_statement_counts', counts)
+        count = counts[key] = counts.get(key, 0) + 1
+        if count != self.nplusone + 1:
+            return
+        if frame is None:
+            frame = _calling_frame(self.app_package)
+        context = _format_frame(frame)
+        ctx.app.logger.warning(
+            'Possible N+1 query: statement executed %d times in one app '
+            'context from %s: %s', count, context, key)
+        nplusone_detected.send(ctx.app, statement=key, count=count,
+                               context=context)
+        if self.nplusone_raise:
+            raise NPlusOneError('statement executed %d times in one app '
+                                'context from %s: %s' % (count, context, key))
 
 
 class _DebugQueryTuple(tuple):
@@ -554,7 +2755,11 @@ class _DebugQueryTuple(tuple):
     parameters = property(itemgetter(1))
     start_time = property(itemgetter(2))
     end_time = property(itemgetter(3))
-    context = property(itemgetter(4))
+    frame = property(itemgetter(4))
+
+    @property
+    def context(self):
+        return _format_frame(self.frame)
 
     @property
     def duration(self):
@@ -568,16 +2773,176 @@ class _DebugQueryTuple(tuple):
         )
 
 
-def _calling_context(app_path):
+#: app path -> code object -> whether the code belongs to the app
+_app_codes = {}
+
+
+def _calling_frame(app_path):
+    """Returns the code and line of the innermost frame that belongs to
+    `app_path`.  Formatting is left to :func:`_format_frame` so that it
+    only happens for queries that are actually looked at.
+
+    The stack is walked right away: the line of a frame moves on once
+    the query returned, and keeping the frame would keep the locals of
+    the whole stack alive for the rest of the app context.  Which code
+    objects belong to the app is remembered, so each frame only costs a
+    dictionary lookup.
+    """
+    codes = _app_codes.get(app_path)
+    if codes is None:
+        codes = _app_codes.setdefault(app_path, {})
     frm = sys._getframe(1)
     while frm.f_back is not None:
-        name = frm.f_globals.get('__name__')
-        if name and (name == app_path or name.startswith(app_path + '.')):
-            funcname = frm.f_code.co_name
-            return '%s:%s (%s)' % (
-                frm.f_code.co_filename,
-                frm.f_lineno,
-                funcname
-            )
+        code = frm.f_code
+        owned = codes.get(code)
+        if owned is None:
+            if len(codes) >= 5000:
+                codes.clear()
+            name = frm.f_globals.get('__name__')
+            owned = codes[code] = bool(name) and (
+                name == app_path or name.startswith(app_path + '.'))
+        if owned:
+            return code, frm.f_lineno
         frm = frm.f_back
-    return '<unknown>'
+    return None
+
+
+def _format_frame(frame):
+    if frame is None:
+        return '<unknown>'
+    code, lineno = frame
+    return '%s:%s (%s)' % (code.co_filename, lineno, code.co_name)
+
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_placeholder = r"(?:\?|%s|%\(\w+\)s|:\w+)"
+_in_list_re = re.compile(r'\bIN\s*\(\s*%s(?:\s*,\s*%s)*\s*\)' % (
+    _placeholder, _placeholder), re.I)
+_whitespace_re = re.compile(r'\s+')
+
+
+_normalized_statements = {}
+
+
+def _normalized_statement(statement):
+    """Cached version of :func:`_normalize_statement`."""
+    rv = _normalized_statements.get(statement)
+    if rv is None:
+        if len(_normalized_statements) >= 5000:
+            _normalized_statements.clear()
+        rv = _normalized_statements[statement] = \
+            _normalize_statement(statement)
+    return rv
+
+
+def _normalize_statement(statement):
+    """Strips literals and collapses IN lists and whitespace so that
+    statements differing only in their values are counted together.
+    """
+    statement = _literal_re.sub('?', statement)
+    statement = _in_list_re.sub('IN (?)', statement)
+    return _whitespace_re.sub(' ', statement).strip()
+
+
+class _StatementStats(object):
+    """Aggregates the executions of one normalized statement.  Percentiles
+    are computed from the most recent `samples` durations.  The rows are
+    the ``rowcount`` of the cursor, i.e. rows affected by writes; most
+    drivers do not report it for SELECTs.
+    """
+
+    max_contexts = 50
+
+    def __init__(self, statement, samples):
+        self.statement = statement
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = 0.0
+        self.rows_affected = 0
+        self.durations = deque(maxlen=samples)
+        self.contexts = {}
+
+    def add(self, duration, rowcount, frame):
+        self.count += 1
+        self.total_time += duration
+        if self.min_time is None or duration < self.min_time:
+            self.min_time = duration
+        if duration > self.max_time:
+            self.max_time = duration
+        if rowcount > 0:
+            self.rows_affected += rowcount
+        self.durations.append(duration)
+        if frame is not None:
+            contexts = self.contexts
+            if frame in contexts:
+                contexts[frame] += 1
+            elif len(contexts) < self.max_contexts:
+                contexts[frame] = 1
+
+    def snapshot(self, top_contexts=5):
+        durations = sorted(self.durations)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1,
+                                 int(len(durations) * p))]
+        contexts = sorted(self.contexts.iteritems(),
+                          key=itemgetter(1), reverse=True)[:top_contexts]
+        return {
+            'statement': self.statement,
+            'count': self.count,
+            'total_time': self.total_time,
+            'min_time': self.min_time,
+            'max_time': self.max_time,
+            'mean_time': self.total_time / self.count,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'rows_affected': self.rows_affected,
+            'contexts': [(_format_frame(frame), count)
+                         for frame, count in contexts],
+        }
+
+
+class _QueryStatistics(object):
+    """Process wide registry of :class:`_StatementStats` keyed by the
+    normalized statement text.  Once `max_statements` statements are
+    tracked the tenth with the least total time is evicted, so a burst
+    of new statements does not push out the expensive ones.
+    """
+
+    max_statements = 5000
+
+    def __init__(self, samples=256):
+        self.samples = samples
+        self._lock = Lock()
+        self._stats = {}
+
+    def add(self, statement, duration, rowcount=-1, frame=None):
+        key = _normalized_statement(statement)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= self.max_statements:
+                    self._evict()
+                stats = self._stats[key] = _StatementStats(key, self.samples)
+            stats.add(duration, rowcount, frame)
+
+    def _evict(self):
+        entries = sorted(self._stats.itervalues(),
+                         key=lambda stats: stats.total_time)
+        for stats in entries[:max(1, len(entries) // 10)]:
+            del self._stats[stats.statement]
+
+    def snapshot(self):
+        with self._lock:
+            rv = [stats.snapshot() for stats in self._stats.itervalues()]
+        rv.sort(key=itemgetter('total_time'), reverse=True)
+        return rv
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+_query_stats = _QueryStatistics()
@@ -0,0 +1,156 @@
+"""
+Micro benchmarks for flask-squll.
+
+Run with ``python -m test.bench [name ...]``.
+"""
+from __future__ import print_function
+
+import subprocess
+import sys
+import threading
+from time import time
+
+import flask
+from flask.ext import squll
+
+
+def _run_threaded(fn, threads, calls):
+    def worker():
+        for _ in xrange(calls):
+            fn()
+    workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+    start = time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time() - start
+
+
+def bench_baked(calls=2000):
+    """``get_or_404``, ``first_or_404`` and ``paginate`` through the baked
+    query cache against the same queries built and compiled every time."""
+    from test.squll_test import make_todo_model
+
+    for size in 0, 500:
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BAKED_QUERIES_SIZE'] = size
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+        db.create_all()
+        for i in xrange(50):
+            db.session.add(Todo('Item %d' % i, 'text'))
+        db.session.commit()
+        for label, fn in (
+                ('get_or_404', lambda i: Todo.query.get_or_404(i % 50 + 1)),
+                ('first_or_404', lambda i: Todo.query.first_or_404()),
+                ('paginate', lambda i: Todo.query.paginate(i % 3 + 1, 10))):
+            start = time()
+            for i in xrange(calls):
+                fn(i)
+                db.session.expunge_all()
+            elapsed = time() - start
+            print('%-8s %-14s %.1fus/call' % (
+                'baked' if size else 'unbaked', label,
+                elapsed * 1e6 / calls))
+
+
+def bench_engine(threads=64, calls=2000):
+    """Engine lookup under N threads: locked connector path against the
+    lock-free registry used by :meth:`Squll.get_engine`."""
+    app = flask.Flask(__name__)
+    db = squll.Squll(app)
+    db.get_engine(app)
+    connector = app.extensions['sqlalchemy'].connectors[None]
+    for label, fn in (('connector (locked)', connector.get_engine),
+                      ('registry (lock-free)', lambda: db.get_engine(app))):
+        elapsed = _run_threaded(fn, threads, calls)
+        print('%-24s %d threads: %.3fs (%.2fus/call)' % (
+            label, threads, elapsed, elapsed * 1e6 / (threads * calls)))
+
+
+def bench_query_property(calls=20000):
+    """``Todo.query.filter_by(...)`` through the cached descriptor against
+    the previous uncached path (``class_mapper`` plus ``session()``)."""
+    from sqlalchemy import orm
+    from test.squll_test import make_todo_model
+
+    app = flask.Flask(__name__)
+    app.config['SQLALCHEMY_ENGINE'] = 'sqlite://'
+    db = squll.Squll(app)
+    Todo = make_todo_model(db)
+
+    def uncached():
+        mapper = orm.class_mapper(Todo)
+        return Todo.query_class(mapper, session=db.session())
+
+    for label, fn in (('uncached', uncached),
+                      ('Todo.query', lambda: Todo.query)):
+        with app.app_context():
+            fn().filter_by(done=False)
+            start = time()
+            for _ in xrange(calls):
+                fn().filter_by(done=False)
+            elapsed = time() - start
+        print('%-12s %.2fus/call' % (label, elapsed * 1e6 / calls))
+
+
+def bench_session(calls=20000):
+    """Creating and removing ``db.session`` in an app context, as a request
+    that never queries does."""
+    app = flask.Flask(__name__)
+    app.config['SQLALCHEMY_BINDS'] = dict(('bind%d' % i, 'sqlite://')
+                                          for i in xrange(5))
+    db = squll.Squll(app)
+    for i in xrange(50):
+        db.Table('table%d' % i, db.Column('id', db.Integer),
+                 info={'bind_key': 'bind%d' % (i % 5)})
+    with app.app_context():
+        start = time()
+        for _ in xrange(calls):
+            db.session()
+            db.session.remove()
+        elapsed = time() - start
+    print('session: %.2fus/call' % (elapsed * 1e6 / calls))
+
+
+def bench_startup(runs=5, instances=1000):
+    """Import time of flask_squll on top of its dependencies and the cost
+    of constructing :class:`Squll` instances."""
+    statement = ('import flask, sqlalchemy.orm, sqlalchemy.ext.declarative\n'
+                 'from time import time\n'
+                 'start = time()\n'
+                 'import flask_squll\n'
+                 'print(time() - start)')
+    elapsed = min(float(subprocess.check_output([sys.executable, '-c',
+                                                 statement]))
+                  for _ in xrange(runs))
+    print('import flask_squll: %.1fms on top of its dependencies'
+          % (elapsed * 1e3))
+
+    start = time()
+    for _ in xrange(instances):
+        squll.Squll()
+    elapsed = time() - start
+    print('Squll(): %.1fus/instance' % (elapsed * 1e6 / instances))
+
+    namespace = squll._get_sqlalchemy_namespace()
+    db = squll.Squll()
+    start = time()
+    for _ in xrange(instances):
+        for key, value in namespace.iteritems():
+            setattr(db, key, value)
+    elapsed = time() - start
+    print('copying the namespace eagerly would add %.1fus/instance'
+          % (elapsed * 1e6 / instances))
+
+
+def main(names):
+    benches = dict((k[6:], v) for k, v in globals().items()
+                   if k.startswith('bench_'))
+    for name in names or sorted(benches):
+        print('== %s' % name)
+        benches[name]()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,13 +1,20 @@
 from __future__ import with_statement
 
 import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 from datetime import datetime
 
 import flask
+import sqlalchemy
 from flask.ext import squll
 
 from flask_squll import get_debug_queries
+from werkzeug.exceptions import NotFound
 
 
 def make_todo_model(db):
@@ -82,6 +89,143 @@ class BasicAppTestCase(unittest.TestCase):
         self.assertEqual(self.db.metadata, self.db.Model.metadata)
 
 
+class QueryRecordingTestCase(unittest.TestCase):
+
+    def make_app(self, **config):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        app.config.update(config)
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+        db.create_all()
+        return app, db, Todo
+
+    def add_todos(self, db, Todo, count):
+        for i in xrange(count):
+            db.session.add(Todo('Test %d' % i, 'test'))
+            db.session.commit()
+
+    def test_limit(self):
+        app, db, Todo = self.make_app(SQLALCHEMY_RECORD_QUERIES_LIMIT=2)
+        with app.test_request_context():
+            self.add_todos(db, Todo, 3)
+            queries = get_debug_queries()
+            self.assertEqual(len(queries), 2)
+            self.assertEqual(queries[-1].parameters[0], 'Test 2')
+            self.assert_('add_todos' in queries[-1].context)
+
+    def test_sampling_and_threshold(self):
+        app, db, Todo = self.make_app(
+            SQLALCHEMY_RECORD_QUERIES_SAMPLE_RATE=0.0)
+        with app.test_request_context():
+            self.add_todos(db, Todo, 2)
+            self.assertEqual(get_debug_queries(), [])
+
+        app, db, Todo = self.make_app(
+            SQLALCHEMY_RECORD_QUERIES_THRESHOLD=60)
+        with app.test_request_context():
+            self.add_todos(db, Todo, 2)
+            self.assertEqual(get_debug_queries(), [])
+
+    def test_runtime_toggle(self):
+        app, db, Todo = self.make_app(SQLALCHEMY_RECORD_QUERIES=False)
+        engine = db.engine
+        with app.test_request_context():
+            self.add_todos(db, Todo, 1)
+            self.assertEqual(get_debug_queries(), [])
+        db.enable_query_recording()
+        with app.test_request_context():
+            self.add_todos(db, Todo, 1)
+            self.assertEqual(len(get_debug_queries()), 1)
+        db.disable_query_recording()
+        with app.test_request_context():
+            self.add_todos(db, Todo, 1)
+            self.assertEqual(get_debug_queries(), [])
+        self.assert_(db.engine is engine)
+
+
+class QueryStatsTestCase(unittest.TestCase):
+
+    def test_normalize_statement(self):
+        self.assertEqual(
+            squll._normalize_statement(
+                "SELECT *  FROM t1\nWHERE a = 'it''s' AND b IN (?, ?, ?) "
+                "AND c > 10.5"),
+            'SELECT * FROM t1 WHERE a = ? AND b IN (?) AND c > ?')
+
+    def test_aggregation(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_QUERY_STATS'] = True
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+        db.create_all()
+        squll.reset_query_stats()
+        for i in xrange(3):
+            db.session.add(Todo('Test %d' % i, 'test'))
+            db.session.commit()
+        # no app context, recording is off: stats are still collected
+        stats = squll.get_query_stats()
+        inserts = [s for s in stats if s['statement'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        insert = inserts[0]
+        self.assertEqual(insert['count'], 3)
+        self.assertEqual(insert['rows_affected'], 3)
+        self.assert_(insert['min_time'] <= insert['p50'] <= insert['max_time'])
+        context, count = insert['contexts'][0]
+        self.assert_('test_aggregation' in context)
+        self.assertEqual(count, 3)
+        squll.reset_query_stats()
+        self.assertEqual(squll.get_query_stats(), [])
+
+    def test_max_statements(self):
+        stats = squll._QueryStatistics()
+        stats.max_statements = 2
+        stats.add('SELECT * FROM a', 0.5)
+        stats.add('SELECT * FROM b', 0.1)
+        stats.add('SELECT * FROM c', 0.2)
+        self.assertEqual([s['statement'] for s in stats.snapshot()],
+                         ['SELECT * FROM a', 'SELECT * FROM c'])
+
+
+class NPlusOneTestCase(unittest.TestCase):
+
+    def make_app(self, **config):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_NPLUSONE_THRESHOLD'] = 2
+        app.config.update(config)
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+        db.create_all()
+        return app, db, Todo
+
+    def test_detection(self):
+        app, db, Todo = self.make_app()
+        detected = []
+
+        def receiver(sender, statement, count, context):
+            detected.append((statement, count, context))
+        with squll.nplusone_detected.connected_to(receiver, sender=app):
+            with app.test_request_context():
+                for i in xrange(2):
+                    Todo.query.filter_by(title='Test %d' % i).all()
+                self.assertEqual(detected, [])
+                Todo.query.filter_by(title='Test 2').all()
+                Todo.query.filter_by(title='Test 3').all()
+        self.assertEqual(len(detected), 1)
+        statement, count, context = detected[0]
+        self.assert_(statement.startswith('SELECT'))
+        self.assertEqual(count, 3)
+        self.assert_('test_detection' in context)
+
+    def test_raise_in_testing(self):
+        app, db, Todo = self.make_app(SQLALCHEMY_NPLUSONE_RAISE=True)
+        with app.test_request_context():
+            Todo.query.all()
+            Todo.query.all()
+            self.assertRaises(squll.NPlusOneError, Todo.query.all)
+
+
 class TestQueryProperty(unittest.TestCase):
 
     def setUp(self):
@@ -116,6 +260,65 @@ class TestQueryProperty(unittest.TestCase):
         db.session.commit()
         self.assertEqual(len(Todo.query.all()), 1)
 
+    def test_mapper_cache(self):
+        db = squll.Squll(self.app)
+
+        class Parent(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+
+        self.assertIn('FROM parent', str(Parent.query))
+
+        # mappers declared after the first query are still configured
+        class Child(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+            parent_id = db.Column(db.Integer, db.ForeignKey(Parent.id))
+            parent = db.relationship(Parent, backref='children')
+
+        db.create_all()
+        db.session.add(Parent(children=[Child()]))
+        db.session.commit()
+        self.assertEqual(len(Parent.query.first().children), 1)
+        self.assertEqual(Child.query.first().parent.id, 1)
+
+        cache = db.Model.__dict__['query']._queries
+        self.assertEqual(set(cache), set([Parent, Child]))
+
+    def test_query_class_with_init(self):
+        db = squll.Squll(self.app)
+        created = []
+
+        class Query(squll.BaseQuery):
+            def __init__(self, *args, **kwargs):
+                created.append(self)
+                super(Query, self).__init__(*args, **kwargs)
+
+        class Item(db.Model):
+            query_class = Query
+            id = db.Column(db.Integer, primary_key=True)
+
+        self.assertIsNot(Item.query, Item.query)
+        self.assertEqual(len(created), 2)
+        self.assertIs(Item.query.session, db.session())
+
+    def test_mapper_events_registered_lazily(self):
+        # only the mapper events are to be seen below
+        squll._register_signal_events()
+        registered = []
+        listen = squll.listen
+        squll.listen = lambda *args: registered.append(args[1])
+        squll._mapper_events_registered = False
+        try:
+            db = squll.Squll()
+            self.assertEqual(registered, [])
+            Todo = make_todo_model(db)
+            db.init_app(self.app)
+            with self.app.app_context():
+                Todo.query
+            self.assertEqual(registered, ['instrument_class'])
+        finally:
+            squll.listen = listen
+            squll._mapper_events_registered = True
+
 
 class SignallingTestCase(unittest.TestCase):
 
@@ -158,6 +361,174 @@ class SignallingTestCase(unittest.TestCase):
             self.assertEqual(recorded[0][1], 'delete')
 
 
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite://'}
+        app.config['SQLALCHEMY_BULK_CHUNK_SIZE'] = 10
+        self.db = db = squll.Squll(app)
+        self.Todo = make_todo_model(db)
+
+        class Foo(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String(20))
+        self.Foo = Foo
+        db.create_all()
+
+    def test_bulk_insert_and_update(self):
+        recorded = []
+
+        def committed(sender, changes):
+            recorded.append(changes)
+        rows = [dict(id=i, title='Item %d' % i, done=False)
+                for i in xrange(1, 26)]
+        with squll.models_committed.connected_to(committed, sender=self.app):
+            self.assertEqual(self.db.bulk_insert(self.Todo, rows), 25)
+            self.assertEqual([len(c) for c in recorded], [10, 10, 5])
+            self.assertEqual(recorded[0][0], (rows[0], 'insert'))
+            del recorded[:]
+            self.db.bulk_update(self.Todo, [dict(id=i, done=True)
+                                            for i in xrange(1, 6)],
+                                summarize=True)
+            self.assertEqual(recorded, [[(self.Todo, 'update')]])
+        self.assertEqual(self.Todo.query.count(), 25)
+        self.assertEqual(self.Todo.query.filter_by(done=True).count(), 5)
+
+    def test_bulk_rows_with_different_keys(self):
+        self.db.bulk_insert(self.Todo, [dict(id=1, title='a'),
+                                        dict(id=2, title='b', done=True)])
+        self.db.bulk_update(self.Todo, [dict(id=1, done=True),
+                                        dict(id=2, done=False, title='c')])
+        self.assertEqual([(t.id, t.title, t.done) for t in
+                          self.Todo.query.order_by(self.Todo.id)],
+                         [(1, 'a', True), (2, 'c', False)])
+
+    def test_bulk_upsert_uses_bind(self):
+        self.db.bulk_insert(self.Foo, [dict(id=1, name='a')])
+        self.db.bulk_upsert(self.Foo, [dict(id=1, name='b'),
+                                       dict(id=2, name='c')])
+        foo = self.db.get_engine(self.app, 'foo')
+        self.assertEqual(
+            list(foo.execute('select id, name from foo order by id')),
+            [(1, 'b'), (2, 'c')])
+
+    def test_bulk_upsert_composite_key(self):
+        db = self.db
+
+        class Pair(db.Model):
+            a = db.Column(db.Integer, primary_key=True)
+            b = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String(20))
+        db.create_all()
+        rows = [dict(a=i % 10, b=i, name='x') for i in xrange(1000)]
+        db.bulk_insert(Pair, rows[:500], chunk_size=1000)
+        for row in rows:
+            row['name'] = 'y'
+        db.bulk_upsert(Pair, rows, chunk_size=1000)
+        self.assertEqual(Pair.query.count(), 1000)
+        self.assertEqual(Pair.query.filter_by(name='y').count(), 1000)
+
+
+class ModificationTrackingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        self.db = squll.Squll(app)
+        self.Todo = make_todo_model(self.db)
+        self.db.create_all()
+
+    def test_tracking_follows_receivers(self):
+        todo = self.Todo('Test', 'test')
+        self.db.session.add(todo)
+        self.db.session.flush()
+        self.assertEqual(self.db.session()._model_changes, {})
+        self.db.session.commit()
+
+        recorded = []
+
+        def committed(sender, changes):
+            recorded.extend(changes)
+        with squll.models_committed.connected_to(committed, sender=self.app):
+            todo.text = 'changed'
+            self.db.session.flush()
+            self.assertEqual(self.db.session()._model_changes.values(),
+                             [(todo, 'update')])
+            self.db.session.commit()
+        self.assertEqual(recorded, [(todo, 'update')])
+
+    def test_disabled_and_compact(self):
+        recorded = []
+
+        def committed(sender, changes):
+            recorded.extend(changes)
+        with squll.models_committed.connected_to(committed, sender=self.app):
+            self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            self.db.session.add(self.Todo('Test', 'test'))
+            self.db.session.commit()
+            self.assertEqual(recorded, [])
+
+            self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = None
+            self.app.config['SQLALCHEMY_COMPACT_MODEL_CHANGES'] = True
+            self.db.session.add(self.Todo('Test', 'test'))
+            self.db.session.commit()
+            self.assertEqual(recorded, [(self.Todo, (2,), 'insert')])
+
+
+class CommitDispatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_COMMIT_DISPATCH'] = 'async'
+        app.config['SQLALCHEMY_COMPACT_MODEL_CHANGES'] = True
+        self.db = squll.Squll(app)
+        self.Todo = make_todo_model(self.db)
+        self.db.create_all()
+
+    def test_async_dispatch(self):
+        recorded = []
+
+        def committed(sender, changes):
+            recorded.append((threading.current_thread().name, changes))
+        with squll.models_committed.connected_to(committed, sender=self.app):
+            self.db.session.add(self.Todo('Test', 'test'))
+            self.db.session.commit()
+            self.assert_(self.db.flush_commit_dispatch(timeout=5))
+        self.assertEqual(len(recorded), 1)
+        thread, changes = recorded[0]
+        self.assert_(thread.startswith('squll-dispatch'))
+        self.assertEqual(changes, [(self.Todo, (1,), 'insert')])
+
+    def test_coalescing_and_backpressure(self):
+        blocked = threading.Event()
+        release = threading.Event()
+        recorded = []
+
+        def committed(sender, changes):
+            recorded.append(changes)
+            if threading.current_thread().name.startswith('squll'):
+                blocked.set()
+                release.wait(5)
+        dispatcher = squll._CommitDispatcher(self.app, workers=1, maxsize=2,
+                                             timeout=0)
+        with squll.models_committed.connected_to(committed, sender=self.app):
+            dispatcher.submit([('a', 'first')])
+            blocked.wait(5)
+            # the worker is busy, a newer change replaces the queued one
+            dispatcher.submit([('b', 'old')])
+            dispatcher.submit([('b', 'new'), ('c', 'other')])
+            self.assertEqual(dispatcher._pending.values(), ['new', 'other'])
+            # the queue is full, this one is sent by the caller
+            dispatcher.submit([('d', 'sync')])
+            self.assertEqual(recorded, [['first'], ['sync']])
+            release.set()
+            dispatcher.close(5)
+        self.assertEqual(recorded[2], ['new', 'other'])
+
+
 class HelperTestCase(unittest.TestCase):
 
     def test_default_table_name(self):
@@ -251,6 +622,583 @@ class BindsTestCase(unittest.TestCase):
         })
 
 
+class BindOptionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'execution_options': {'stream_results': False,
+                                  'autocommit': True}}
+        app.config['SQLALCHEMY_POOL_RECYCLE'] = 3600
+        app.config['SQLALCHEMY_BINDS'] = {
+            'analytics': {'uri': 'sqlite://', 'pool_size': 20,
+                          'execution_options': {'stream_results': True}},
+            'cache': {'uri': 'sqlite://', 'pool_recycle': 60},
+            'plain': 'sqlite://'}
+        self.db = squll.Squll(app)
+
+    def test_bind_options(self):
+        db, app = self.db, self.app
+        analytics = db.get_engine(app, 'analytics')
+        self.assertEqual(analytics.pool.size, 20)
+        self.assertEqual(analytics.pool._recycle, 3600)
+        self.assertEqual(analytics._execution_options,
+                         {'stream_results': True,
+                          'autocommit': True})
+        cache = db.get_engine(app, 'cache')
+        self.assertEqual(cache.pool._recycle, 60)
+        self.assertEqual(cache._execution_options['stream_results'], False)
+        self.assertEqual(db.get_engine(app, 'plain').pool._recycle, 3600)
+
+    def test_changed_options(self):
+        db, app = self.db, self.app
+        engine = db.get_engine(app, 'cache')
+        db.get_binds(app)
+        app.config['SQLALCHEMY_BINDS']['cache']['pool_recycle'] = 30
+        db.get_binds(app)
+        self.assert_(db.get_engine(app, 'cache') is not engine)
+        self.assertEqual(db.get_engine(app, 'cache').pool._recycle, 30)
+
+    def test_uncopyable_options(self):
+        db, app = self.db, self.app
+        # a given pool takes no pool settings
+        app.config['SQLALCHEMY_POOL_RECYCLE'] = None
+        pool = sqlalchemy.pool.StaticPool(
+            lambda: sqlite3.connect(':memory:'))
+        lock = threading.Lock()
+        app.config['SQLALCHEMY_BINDS']['static'] = {
+            'uri': 'sqlite://', 'pool': pool,
+            'connect_args': {'check_same_thread': False, 'lock': lock}}
+        engine = db.get_engine(app, 'static')
+        self.assert_(engine.pool is pool)
+        db.get_binds(app)
+        self.assert_(db.get_engine(app, 'static') is engine)
+        app.config['SQLALCHEMY_BINDS']['static']['connect_args'] = {}
+        db.get_binds(app)
+        self.assert_(db.get_engine(app, 'static') is not engine)
+
+    def test_missing_uri(self):
+        self.app.config['SQLALCHEMY_BINDS']['broken'] = {'pool_size': 1}
+        self.assertRaises(AssertionError, self.db.get_engine, self.app,
+                          'broken')
+
+
+class InheritedBindTestCase(unittest.TestCase):
+
+    def test_bind_key_from_parent(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite://'}
+        db = squll.Squll(app)
+
+        class Parent(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+            type = db.Column(db.Unicode(20))
+            __mapper_args__ = {'polymorphic_on': type}
+
+        class Child(Parent):
+            id = db.Column(db.Integer, db.ForeignKey('parent.id'),
+                           primary_key=True)
+            __mapper_args__ = {'polymorphic_identity': u'child'}
+
+        self.assertEqual(Child.__table__.info['bind_key'], 'foo')
+        db.create_all()
+        db.session.add(Child())
+        db.session.commit()
+        self.assertEqual(len(Child.query.all()), 1)
+
+        foo = db.get_engine(app, 'foo')
+        self.assert_(db.session.get_bind(Child.__mapper__) is foo)
+        mapper_binds = app.extensions['sqlalchemy'].mapper_binds
+        self.assertEqual(mapper_binds[Child.__mapper__], ('foo', foo))
+
+
+class ParallelDDLTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            (key, 'sqlite:///' + os.path.join(self.tmpdir, key + '.db'))
+            for key in ('foo', 'bar'))
+        app.config['SQLALCHEMY_PARALLEL_DDL'] = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_db(self):
+        db = squll.Squll(self.app)
+
+        class Foo(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Bar(db.Model):
+            __bind_key__ = 'bar'
+            id = db.Column(db.Integer, primary_key=True)
+
+        class Baz(db.Model):
+            __bind_key__ = 'bar'
+            id = db.Column(db.Integer, primary_key=True)
+            bar_id = db.Column(db.Integer, db.ForeignKey('bar.id'))
+        return db
+
+    def test_create_and_reflect(self):
+        timings = self.make_db().create_all()
+        self.assertEqual(timings.keys(), [None, 'foo', 'bar'])
+
+        db = squll.Squll(self.app)
+        db.reflect()
+        tables = db.metadata.tables
+        self.assertEqual(sorted(tables), ['bar', 'baz', 'foo'])
+        self.assertEqual(tables['baz'].info['bind_key'], 'bar')
+        self.assertEqual(db.get_tables_for_bind('foo'), [tables['foo']])
+
+    def test_ordered_errors(self):
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'foo': 'sqlite:////nonexistent/foo.db',
+            'bar': 'sqlite:////nonexistent/bar.db',
+        }
+        db = self.make_db()
+        try:
+            db.create_all(bind=['bar', 'foo'])
+        except squll.BindError as e:
+            self.assertEqual([bind for bind, exc, tb in e.errors],
+                             ['bar', 'foo'])
+        else:
+            self.fail('BindError not raised')
+
+    def test_thread_local_pool_errors(self):
+        db = self.make_db()
+        jobs = [(None, db.engine), ('foo', db.get_engine(self.app, 'foo'))]
+        self.assert_(isinstance(db.engine.pool,
+                                sqlalchemy.pool.SingletonThreadPool))
+        called = []
+
+        def fail(bind, engine):
+            called.append(bind)
+            raise ValueError(bind)
+        try:
+            squll._run_per_bind(jobs, fail)
+        except squll.BindError as e:
+            self.assertEqual([bind for bind, exc, tb in e.errors],
+                             [None, 'foo'])
+        else:
+            self.fail('BindError not raised')
+        self.assertEqual(called, [None, 'foo'])
+
+
+class ReflectionCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.tmpdir, 'db.db')
+        app.config['SQLALCHEMY_REFLECTION_CACHE'] = self.tmpdir
+        db = squll.Squll(app)
+        db.engine.execute('create table a (id integer primary key)')
+        db.engine.execute('create table b (id integer primary key, '
+                          'a_id integer references a(id))')
+        self.reflected = []
+        reflect = sqlalchemy.MetaData.reflect
+
+        def recording_reflect(metadata, bind=None, only=None, **kw):
+            self.reflected.append(only)
+            return reflect(metadata, bind=bind, only=only, **kw)
+        sqlalchemy.MetaData.reflect = recording_reflect
+        self.addCleanup(setattr, sqlalchemy.MetaData, 'reflect', reflect)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def reflect(self):
+        db = squll.Squll(self.app)
+        db.reflect()
+        return db.metadata.tables
+
+    def test_cache(self):
+        self.assertEqual(sorted(self.reflect()), ['a', 'b'])
+        self.assertEqual(self.reflected, [['a', 'b']])
+        del self.reflected[:]
+
+        tables = self.reflect()
+        self.assertEqual(self.reflected, [])
+        self.assertEqual(list(tables['b'].c.a_id.foreign_keys)[0].column,
+                         tables['a'].c.id)
+
+        engine = squll.Squll(self.app).engine
+        engine.execute('alter table b add column name varchar(20)')
+        tables = self.reflect()
+        self.assertEqual(self.reflected, [['b']])
+        self.assert_('name' in tables['b'].c)
+
+    def test_views_are_skipped(self):
+        engine = squll.Squll(self.app).engine
+        engine.execute('create view v as select id from a')
+        self.assertEqual(sorted(self.reflect()), ['a', 'b'])
+        self.assertEqual(self.reflected, [['a', 'b']])
+
+
+class ReplicaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        uris = dict((name, 'sqlite:///' + os.path.join(self.tmpdir, name))
+                    for name in ('primary', 'r1', 'r2', 'foo', 'foo_r'))
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = uris['primary']
+        app.config['SQLALCHEMY_BINDS'] = {'foo': uris['foo']}
+        app.config['SQLALCHEMY_REPLICAS'] = {None: [uris['r1'], uris['r2']],
+                                             'foo': [uris['foo_r']]}
+        self.db = db = squll.Squll(app)
+
+        class Item(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String(20))
+
+        class Other(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String(20))
+
+        self.Item = Item
+        self.Other = Other
+        for name, uri in uris.items():
+            engine = sqlalchemy.create_engine(uri)
+            table = (name.startswith('foo') and Other or Item).__table__
+            table.create(engine)
+            engine.execute(table.insert(), id=1, name=name)
+            engine.dispose()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def name(self, model):
+        rv = model.query.first().name
+        self.db.session.remove()
+        return rv
+
+    def test_round_robin(self):
+        self.assertEqual([self.name(self.Item) for _ in xrange(4)],
+                         ['r1', 'r2', 'r1', 'r2'])
+        self.assertEqual(self.name(self.Other), 'foo_r')
+
+    def test_writes_pin_primary(self):
+        self.app.config['SQLALCHEMY_REPLICA_PIN_WINDOW'] = 60
+        session = self.db.session()
+        self.assertEqual(self.Item.query.first().name, 'r1')
+        session.add(self.Item(name='new'))
+        session.flush()
+        # the replicas do not know about the open transaction
+        self.assertEqual(self.Item.query.count(), 2)
+        session.commit()
+        self.assertEqual(self.Item.query.count(), 2)
+        # the pin outlives the session, but only for the written bind
+        self.db.session.remove()
+        self.assertEqual(self.Item.query.count(), 2)
+        self.assertEqual(self.name(self.Other), 'foo_r')
+        self.app.config['SQLALCHEMY_REPLICA_PIN_WINDOW'] = 0
+        self.assertEqual(self.Item.query.count(), 1)
+        self.db.session.remove()
+
+    def test_direct_connection_pins_primary(self):
+        self.app.config['SQLALCHEMY_REPLICA_PIN_WINDOW'] = 60
+        conn = self.db.session.connection(self.Other.__mapper__)
+        conn.execute(self.Other.__table__.insert(), name='new')
+        self.db.session.commit()
+        self.db.session.remove()
+        self.assertEqual(self.Other.query.count(), 2)
+        self.assertEqual(self.name(self.Item), 'r1')
+
+    def test_locking_reads(self):
+        self.assertEqual(self.Item.query.with_lockmode('update')
+                         .first().name, 'primary')
+
+    def test_least_connections(self):
+        class Pool(object):
+            def __init__(self):
+                self.connections = 0
+
+            def checkedout(self):
+                return self.connections
+
+        engines = [type('Engine', (object,), {'pool': Pool()})()
+                   for _ in xrange(3)]
+        replicas = squll._ReplicaSet(engines, 'least_connections')
+        self.assertEqual([replicas.choose() for _ in xrange(3)], engines)
+        engines[0].pool.connections = engines[1].pool.connections = 1
+        self.assertEqual([replicas.choose() for _ in xrange(3)],
+                         [engines[2]] * 3)
+        self.assertRaises(ValueError, squll._ReplicaSet, [], 'random')
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.tmpdir, 'db')
+        app.config['SQLALCHEMY_BINDS'] = {'foo': {
+            'uri': 'sqlite:///' + os.path.join(self.tmpdir, 'foo'),
+            'pool_size': 5}}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 2,
+            'max_overflow': 1, 'pool_timeout': 0.01}
+        app.config['SQLALCHEMY_POOL_METRICS'] = True
+        self.db = squll.Squll(app)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_options(self):
+        pool = self.db.get_engine(self.app).pool
+        self.assert_(isinstance(pool, sqlalchemy.pool.QueuePool))
+        self.assertEqual((pool.size(), pool._max_overflow), (2, 1))
+        pool = self.db.get_engine(self.app, 'foo').pool
+        self.assertEqual((pool.size(), pool._max_overflow), (5, 1))
+
+    def test_metrics(self):
+        engine = self.db.get_engine(self.app)
+        conns = [engine.connect() for _ in xrange(3)]
+        self.assertRaises(sqlalchemy.exc.TimeoutError, engine.connect)
+        metrics = self.db.get_pool_metrics(self.app)[None]
+        self.assertEqual((metrics['checkedout'], metrics['overflow']), (3, 1))
+        self.assertEqual(metrics['checkout_wait']['count'], 4)
+        self.assertEqual(metrics['connect']['count'], 3)
+        self.assertEqual(metrics['timeouts'], 1)
+        self.assertEqual(sum(n for _, n in
+                             metrics['checkout_wait']['buckets']), 4)
+        for conn in conns:
+            conn.close()
+        engine.dispose()
+        engine.connect().close()
+        metrics = self.db.get_pool_metrics(self.app)
+        self.assertEqual(metrics[None]['checkout_wait']['count'], 5)
+        self.assertEqual(metrics[None]['checkedin'], 1)
+        self.assertEqual(metrics['foo']['pool'], 'MeteredQueuePool')
+
+    def test_lifo(self):
+        self.app.config['SQLALCHEMY_POOL_USE_LIFO'] = True
+        engine = self.db.get_engine(self.app)
+        first, second = engine.connect(), engine.connect()
+        dbapi_connection = second.connection.connection
+        first.close()
+        second.close()
+        conn = engine.connect()
+        self.assert_(conn.connection.connection is dbapi_connection)
+        conn.close()
+
+    def test_pre_ping(self):
+        self.app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+        engine = self.db.get_engine(self.app)
+        engine.connect().close()
+        # the idle connection in the pool goes away
+        engine.pool._pool.queue[0].connection.close()
+        self.assertEqual(engine.execute('select 1').scalar(), 1)
+
+
+class EngineRegistryTestCase(unittest.TestCase):
+
+    def test_registry_and_invalidation(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite://'}
+        db = squll.Squll(app)
+
+        engine = db.get_engine(app, 'foo')
+        state = app.extensions['sqlalchemy']
+        self.assert_(state.engines['foo'] is engine)
+        self.assert_(db.get_engine(app, 'foo') is engine)
+
+        # config changes are only noticed after an explicit invalidate
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite:///:memory:'}
+        self.assert_(db.get_engine(app, 'foo') is engine)
+        db.invalidate_engines(app, 'foo')
+        self.assert_('foo' not in state.engines)
+        new_engine = db.get_engine(app, 'foo')
+        self.assert_(new_engine is not engine)
+        self.assertEqual(str(new_engine.url), 'sqlite:///:memory:')
+
+    def test_binds_map_is_cached(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite://'}
+        db = squll.Squll(app)
+
+        class Foo(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+
+        binds = db.get_binds(app)
+        self.assert_(db.get_binds(app) is binds)
+        self.assertEqual(db.get_tables_for_bind('foo'), [Foo.__table__])
+
+        # new tables rebuild the map
+        class Bar(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+
+        binds = db.get_binds(app)
+        self.assertEqual(binds[Bar.__table__], db.engine)
+        self.assertEqual(db.get_tables_for_bind(), [Bar.__table__])
+
+        # so does a change of the configured binds
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite:///:memory:'}
+        new_binds = db.get_binds(app)
+        self.assert_(new_binds is not binds)
+        self.assertEqual(str(new_binds[Foo.__table__].url),
+                         'sqlite:///:memory:')
+
+
+class ForkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.tmpdir, 'db')
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': sqlalchemy.pool.QueuePool}
+        app.config['SQLALCHEMY_BINDS'] = {'foo': {
+            'uri': 'sqlite:///' + os.path.join(self.tmpdir, 'foo'),
+            'poolclass': sqlalchemy.pool.QueuePool}}
+        self.db = db = squll.Squll(app)
+        self.Todo = make_todo_model(db)
+
+        class Foo(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+        self.Foo = Foo
+        db.create_all()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pid_change_bind_key_model(self):
+        self.assertEqual(self.Foo.query.all(), [])
+        engine = self.db.get_engine(self.app, 'foo')
+        pool = engine.pool
+        state = squll.get_state(self.app)
+        state.pid = -1
+        self.db.session.remove()
+        self.assertEqual(self.Foo.query.all(), [])
+        self.assertEqual(state.pid, os.getpid())
+        self.assert_(engine.pool is not pool)
+        self.assert_(pool in state.orphaned_pools)
+
+    def test_pid_change(self):
+        engine = self.db.engine
+        pool = engine.pool
+        conn = engine.connect()
+        state = squll.get_state(self.app)
+        state.pid = -1
+        self.assert_(self.db.engine is engine)
+        self.assert_(engine.pool is not pool)
+        self.assert_(pool in state.orphaned_pools)
+        self.assertEqual(state.pid, os.getpid())
+        # the inherited connection is left alone
+        self.assertEqual(conn.execute('select 1').scalar(), 1)
+        conn.close()
+        self.assertEqual(self.Todo.query.count(), 0)
+
+    def test_fork(self):
+        self.assertEqual(self.Todo.query.count(), 0)
+        parent_pool = self.db.engine.pool
+        pid = os.fork()
+        if not pid:
+            ok = False
+            try:
+                with self.app.test_request_context():
+                    self.db.session.add(self.Todo('child', 'text'))
+                    self.db.session.commit()
+                    ok = self.db.engine.pool is not parent_pool
+            finally:
+                os._exit(0 if ok else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.Todo.query.count(), 1)
+
+    def test_dispose_all(self):
+        engine = self.db.engine
+        engine.connect().close()
+        self.assertEqual(engine.pool.checkedin(), 1)
+        self.db.before_fork()
+        self.assertEqual(engine.pool.checkedin(), 0)
+        self.assert_(self.db.engine is engine)
+
+
+class ReleaseConnectionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.tmpdir, 'db')
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': sqlalchemy.pool.QueuePool}
+        app.config['SQLALCHEMY_POOL_METRICS'] = True
+        app.config['SQLALCHEMY_RELEASE_CONNECTIONS'] = True
+        self.db = squll.Squll(app)
+        self.Todo = make_todo_model(self.db)
+        self.db.create_all()
+        with app.test_request_context():
+            self.db.session.add(self.Todo('First', 'The text'))
+            self.db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_releases_connection(self):
+        pool = self.db.engine.pool
+        with self.app.test_request_context():
+            todos = self.Todo.query.all()
+            self.assertEqual(pool.checkedout(), 0)
+            self.assertEqual(todos[0].title, 'First')
+            self.assertEqual(self.Todo.query.count(), 1)
+            self.assertEqual(pool.checkedout(), 0)
+            self.assert_(squll.get_pool_hold_time() > 0)
+        metrics = self.db.get_pool_metrics(self.app)[None]
+        self.assert_(metrics['hold']['count'] > 0)
+
+    def test_changes_keep_connection(self):
+        pool = self.db.engine.pool
+        with self.app.test_request_context():
+            todo = self.Todo.query.first()
+            todo.done = True
+            self.Todo.query.all()
+            self.assertEqual(pool.checkedout(), 1)
+            self.db.session.commit()
+            self.assertEqual(pool.checkedout(), 0)
+            self.db.session.execute(
+                self.Todo.__table__.update().values(text='changed'))
+            self.Todo.query.all()
+            self.assertEqual(pool.checkedout(), 1)
+            self.db.session.rollback()
+
+    def test_direct_connection_keeps_transaction(self):
+        with self.app.test_request_context():
+            conn = self.db.session.connection()
+            conn.execute(self.Todo.__table__.insert(),
+                         title='Second', text='text', done=False)
+            self.Todo.query.all()
+            self.db.session.commit()
+        self.assertEqual(self.Todo.query.count(), 2)
+
+    def test_locking_select_keeps_connection(self):
+        pool = self.db.engine.pool
+        with self.app.test_request_context():
+            self.Todo.query.with_lockmode('update').first()
+            self.assert_(self.db.session().transaction._connections)
+            self.assertEqual(pool.checkedout(), 1)
+            self.db.session.commit()
+            self.assertEqual(pool.checkedout(), 0)
+
+    def test_disabled(self):
+        self.app.config['SQLALCHEMY_RELEASE_CONNECTIONS'] = False
+        pool = self.db.engine.pool
+        with self.app.test_request_context():
+            self.Todo.query.all()
+            self.assertEqual(pool.checkedout(), 1)
+
+
 class DefaultQueryClassTestCase(unittest.TestCase):
 
     def test_default_query_class(self):
@@ -290,6 +1238,16 @@ class SQLAlchemyIncludesTestCase(unittest.TestCase):
         from flask.ext.squll import BaseQuery
         self.assertTrue(db.Query == BaseQuery)
 
+    def test_lazy_namespace(self):
+        db = squll.Squll()
+        self.assertFalse('relationship' in db.__dict__)
+        relationship = db.relationship
+        self.assertTrue(db.__dict__['relationship'] is relationship)
+        self.assertTrue(squll.Squll().relationship is relationship)
+        self.assertTrue(db.Table is db.Table)
+        self.assertFalse(db.Table is squll.Squll().Table)
+        self.assertRaises(AttributeError, getattr, db, 'no_such_name')
+
 
 class RegressionTestCase(unittest.TestCase):
 
@@ -383,6 +1341,35 @@ class SessionScopingTestCase(unittest.TestCase):
             db.session.add(fb)
             assert fb in db.session
 
+    def test_lazy_session(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BINDS'] = {'foo': 'sqlite://'}
+        app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+
+        class Other(db.Model):
+            __bind_key__ = 'foo'
+            id = db.Column(db.Integer, primary_key=True)
+
+        state = squll.get_state(app)
+        with app.test_request_context():
+            pass
+        self.assertFalse(db.session.registry.has())
+        with app.test_request_context():
+            db.session()
+            Todo.query.filter_by(done=False)
+            self.assertEqual((state.engines, state.binds), ({}, None))
+        self.assertFalse(db.session.registry.has())
+
+        db.create_all()
+        with app.test_request_context():
+            self.assert_(db.session.bind is db.engine)
+            self.assertEqual(db.session.execute(
+                Other.__table__.count()).scalar(), 0)
+            self.assert_(db.session.get_bind(
+                None, Other.__table__.select()) is db.get_engine(app, 'foo'))
+
     def test_session_scoping_changing(self):
         app = flask.Flask(__name__)
         app.config['SQLALCHEMY_ENGINE'] = 'sqlite://'
@@ -422,19 +1409,470 @@ class PaginationTestCase(unittest.TestCase):
                          [1, 2, None, 8, 9, 10, 11, 12, 13, 14, None, 24, 25])
 
 
+class PaginateCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        self.db = db = squll.Squll(app)
+        self.Todo = Todo = make_todo_model(db)
+        db.create_all()
+        for i in xrange(25):
+            db.session.add(Todo('Item %d' % i, 'text'))
+        db.session.commit()
+
+    def test_without_count(self):
+        p = self.Todo.query.paginate(2, per_page=10, count=False)
+        self.assertEqual(p.total, None)
+        self.assertEqual(len(p.items), 10)
+        self.assert_(p.has_next)
+        self.assertEqual(p.pages, 3)
+        self.assertEqual(list(p.iter_pages()), [1, 2, 3])
+        p = p.next()
+        self.assertEqual(len(p.items), 5)
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.pages, 3)
+
+    def test_estimated_count(self):
+        p = self.Todo.query.paginate(1, per_page=10, count=lambda q: 1000)
+        self.assert_(p.estimated)
+        self.assertEqual(p.total, 1000)
+        self.assertEqual(p.pages, 100)
+        p = p.next().next()
+        # the last page is known even though the estimate is off
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.pages, 3)
+
+    def test_cached_count(self):
+        query = self.Todo.query.filter(self.Todo.text == 'text')
+        self.assertEqual(query.paginate(2, per_page=10,
+                                        count_ttl=60).total, 25)
+        self.db.session.add(self.Todo('Item', 'text'))
+        self.db.session.commit()
+        p = query.paginate(2, per_page=10, count_ttl=60)
+        self.assertEqual(p.total, 25)
+        self.assertEqual(p.options, {'count_ttl': 60})
+        self.assertEqual(query.paginate(2, per_page=10).total, 26)
+
+
+class BakedQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        self.db = db = squll.Squll(app)
+        self.Todo = Todo = make_todo_model(db)
+        db.create_all()
+        for i in xrange(25):
+            db.session.add(Todo('Item %d' % i, 'text'))
+        db.session.commit()
+        db.session.remove()
+
+    def stats(self):
+        return self.db.get_baked_query_stats(self.app)
+
+    def test_get_or_404(self):
+        Todo = self.Todo
+        self.assertEqual(Todo.query.get_or_404(3).title, 'Item 2')
+        self.assertEqual(self.stats()['misses'], 1)
+        self.db.session.remove()
+        todo = Todo.query.get_or_404(4)
+        self.assertEqual(todo.title, 'Item 3')
+        self.assertEqual(self.stats()['hits'], 1)
+        # served from the identity map
+        self.assert_(Todo.query.get_or_404(4) is todo)
+        self.assertEqual(self.stats()['hits'], 1)
+        self.assertRaises(NotFound, Todo.query.get_or_404, 100)
+        self.assertEqual(self.stats()['hits'], 2)
+
+    def test_first_or_404(self):
+        Todo = self.Todo
+        self.assertEqual(Todo.query.first_or_404().title, 'Item 0')
+        self.assertEqual(Todo.query.first_or_404().title, 'Item 0')
+        self.assertEqual(self.stats()['hits'], 1)
+        # filtered queries are not cached
+        self.assertRaises(NotFound, Todo.query.filter_by(
+            title='missing').first_or_404)
+        self.assertEqual(self.stats()['size'], 1)
+
+    def test_paginate(self):
+        Todo = self.Todo
+        p = Todo.query.paginate(2, per_page=10)
+        self.assertEqual([t.title for t in p.items][:1], ['Item 10'])
+        self.assertEqual(p.total, 25)
+        p = Todo.query.paginate(2, per_page=10)
+        self.assertEqual(p.total, 25)
+        self.assertEqual(self.stats()['hits'], 2)
+        # all pages share one entry
+        self.assertEqual([t.title for t in p.next().items],
+                         ['Item %d' % i for i in xrange(20, 25)])
+        self.assertEqual([t.title for t in Todo.query.paginate(
+            1, per_page=10).items][-1:], ['Item 9'])
+        self.assertEqual(self.stats()['misses'], 2)
+        self.assertEqual(self.stats()['size'], 2)
+
+    def test_baked(self):
+        Todo = self.Todo
+        bindparam = self.db.bindparam
+
+        def titles(title):
+            return [t.title for t in Todo.query.baked(
+                lambda q: q.filter(Todo.title == bindparam('title'))
+            ).params(title=title)]
+
+        self.assertEqual(titles('Item 1'), ['Item 1'])
+        self.assertEqual(titles('Item 2'), ['Item 2'])
+        self.assertEqual(self.stats(), {'size': 1, 'capacity': 500,
+                                        'hits': 1, 'misses': 1,
+                                        'evictions': 0})
+        query = Todo.query.baked(lambda q: q.filter(
+            Todo.title.like(bindparam('title'))), key='like')
+        self.assertEqual(query.params(title='Item 1%').count(), 11)
+        self.assertEqual(query.params(title='Item 2%').filter(
+            Todo.id > 21).count(), 4)
+
+    def test_baked_closure(self):
+        Todo = self.Todo
+
+        def titles(title):
+            return [t.title for t in Todo.query.baked(
+                lambda q: q.filter_by(title=title))]
+        self.assertEqual(titles('Item 1'), ['Item 1'])
+        self.assertEqual(titles('Item 2'), ['Item 2'])
+        self.assertEqual(titles('Item 1'), ['Item 1'])
+        self.assertEqual(self.stats()['size'], 2)
+        self.assertEqual(self.stats()['hits'], 1)
+        # neither can default arguments and globals be left out
+        for title in 'Item 4', 'Item 5':
+            self.assertEqual([t.title for t in Todo.query.baked(
+                lambda q, title=title: q.filter_by(title=title))], [title])
+        global _baked_title
+        for _baked_title in 'Item 6', 'Item 7':
+            self.assertEqual([t.title for t in Todo.query.baked(
+                lambda q: q.filter_by(title=_baked_title))],
+                [_baked_title])
+        self.assertEqual(self.stats()['size'], 6)
+        # a list can not be part of the key, the query is not cached
+        names = ['Item 3']
+        self.assertEqual([t.title for t in Todo.query.baked(
+            lambda q: q.filter(Todo.title.in_(names)))], ['Item 3'])
+        self.assertEqual(self.stats()['size'], 6)
+
+    def test_eviction(self):
+        squll.get_state(self.app).baked_queries = squll._BakedQueryCache(2)
+        for key in 'a', 'b', 'a', 'c', 'b':
+            self.Todo.query.baked(lambda q: q.limit(1), key=key).all()
+        self.assertEqual(self.stats(), {'size': 2, 'capacity': 2,
+                                        'hits': 1, 'misses': 4,
+                                        'evictions': 2})
+
+    def test_disabled(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_BAKED_QUERIES_SIZE'] = 0
+        db = squll.Squll(app)
+        Todo = make_todo_model(db)
+        db.create_all()
+        self.assertEqual(db.get_baked_query_stats(), None)
+        self.assertRaises(NotFound, Todo.query.first_or_404)
+        self.assertEqual(Todo.query.paginate(1).total, 0)
+
+
+class ModelCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        self.db = db = squll.Squll(app)
+
+        class User(db.Model):
+            __cache__ = True
+            id = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String(20))
+
+        self.User = User
+        db.create_all()
+        db.session.add_all([User(name='joe'), User(name='ann')])
+        db.session.commit()
+        db.session.remove()
+
+    def get(self, ident):
+        user = self.User.query.get_or_404(ident)
+        name = user.name
+        self.db.session.remove()
+        return name
+
+    def stats(self):
+        return self.db.get_model_cache_stats(self.app)
+
+    def test_cached_get(self):
+        self.assertEqual(self.get(1), 'joe')
+        with self.app.test_request_context():
+            self.assertEqual(self.get(1), 'joe')
+            self.assertEqual(len(get_debug_queries()), 0)
+        self.assertEqual(self.stats()['hits'], 1)
+        self.assertEqual(self.stats()['hit_ratio'], 0.5)
+        # the merged instance is persistent in the session
+        user = self.User.query.get(1)
+        user.name = 'jim'
+        self.db.session.commit()
+        self.db.session.remove()
+        self.assertEqual(self.stats()['invalidations'], 1)
+        self.assertEqual(self.get(1), 'jim')
+        self.assertEqual(self.stats()['misses'], 2)
+
+    def test_delete(self):
+        self.assertEqual(self.get(2), 'ann')
+        self.db.session.delete(self.User.query.get(2))
+        self.db.session.commit()
+        self.db.session.remove()
+        self.assertRaises(NotFound, self.User.query.get_or_404, 2)
+
+    def test_bulk(self):
+        self.assertEqual(self.get(1), 'joe')
+        self.db.bulk_update(self.User, [{'id': 1, 'name': 'jim'}])
+        self.assertEqual(self.get(1), 'jim')
+        self.db.bulk_update(self.User, [{'id': 1, 'name': 'jo'}],
+                            summarize=True)
+        self.assertEqual(self.get(1), 'jo')
+        self.assertEqual(self.stats()['hits'], 0)
+
+    def test_untracked_session(self):
+        self.assertEqual(self.get(1), 'joe')
+        session = self.db.create_scoped_session(
+            {'track_modifications': False})
+        session.query(self.User).get(1).name = 'jim'
+        session.commit()
+        session.remove()
+        self.assertEqual(self.get(1), 'jim')
+
+    def test_query_update(self):
+        self.assertEqual(self.get(1), 'joe')
+        self.User.query.filter_by(id=1).update({'name': 'jim'})
+        self.assertEqual(self.db.session.query(self.User.name).filter_by(
+            id=1).scalar(), 'jim')
+        self.db.session.commit()
+        self.db.session.remove()
+        self.assertEqual(self.get(1), 'jim')
+
+    def test_rollback(self):
+        self.assertEqual(self.get(1), 'joe')
+        self.User.query.get(1).name = 'jim'
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.remove()
+        self.assertEqual(self.get(1), 'joe')
+        self.assertEqual(self.stats()['invalidations'], 0)
+
+    def test_compact_changes(self):
+        self.app.config['SQLALCHEMY_COMPACT_MODEL_CHANGES'] = True
+        self.assertEqual(self.get(1), 'joe')
+        self.User.query.get(1).name = 'jim'
+        self.db.session.commit()
+        self.db.session.remove()
+        self.assertEqual(self.get(1), 'jim')
+
+    def test_backend(self):
+        store = {}
+
+        class DictBackend(squll.CacheBackend):
+            get = store.get
+            delete = lambda self, key: store.pop(key, None)
+
+            def set(self, key, value, ttl):
+                store[key] = value
+
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_CACHE_BACKEND'] = DictBackend()
+        db = squll.Squll(app)
+
+        class Item(db.Model):
+            __cache__ = 10
+            id = db.Column(db.Integer, primary_key=True)
+
+        db.create_all()
+        db.session.add(Item())
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(Item.query.get(1).id, 1)
+        self.assertEqual(len(store), 1)
+        self.assert_(isinstance(store.values()[0], bytes))
+
+    def test_lru_backend(self):
+        backend = squll.LRUCacheBackend(2)
+        backend.set('a', 'x', 10)
+        backend.set('b', 'y', 10)
+        backend.get('a')
+        backend.set('c', 'z', 10)
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('a'), 'x')
+        backend.set('d', 'w', -1)
+        self.assertEqual(backend.get('d'), None)
+
+    def test_disabled(self):
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db = squll.Squll(app)
+        self.assertEqual(db.get_model_cache_stats(app), None)
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        self.db = db = squll.Squll(app)
+        self.Todo = Todo = make_todo_model(db)
+        db.create_all()
+        for i in xrange(25):
+            db.session.add(Todo('Item %d' % i, 'text'))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def check_stream(self, rows):
+        ids = []
+        for todo in rows:
+            self.assert_(len(self.db.session.identity_map) <= 10)
+            ids.append(todo.id)
+        self.assertEqual(ids, range(1, 26))
+        self.assertEqual(len(self.db.session.identity_map), 0)
+
+    def test_keyset_batches(self):
+        self.check_stream(self.Todo.query.stream(batch_size=10))
+
+    def test_server_side_cursor(self):
+        query = self.Todo.query.order_by(self.Todo.id)
+        self.check_stream(query._stream_cursor(10))
+
+    def test_limit_and_offset(self):
+        Todo = self.Todo
+        query = Todo.query.order_by(Todo.title).offset(3).limit(15)
+        for rows in (query.stream(batch_size=10),
+                     query.stream(batch_size=4, order_columns=[Todo.id]),
+                     query._reordered([Todo.id])._stream_cursor(4)):
+            self.assertEqual([t.id for t in rows], range(4, 19))
+        self.assertEqual(list(query.limit(0).stream()), [])
+
+    def test_changes_are_kept(self):
+        Todo = self.Todo
+        first = Todo.query.get(1)
+        first.done = True
+        second = Todo.query.get(2)
+        for query in (Todo.query.stream(batch_size=10),
+                      Todo.query.order_by(Todo.id)._stream_cursor(10)):
+            for todo in query:
+                if todo.id == 20:
+                    todo.text = 'changed'
+            self.assert_(first in self.db.session)
+            self.assert_(second in self.db.session)
+        self.db.session.commit()
+        self.assertEqual(Todo.query.filter_by(done=True).count(), 1)
+        self.assertEqual(Todo.query.filter_by(text='changed').count(), 1)
+
+
+class SeekPaginationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        db = squll.Squll(app)
+        self.Todo = Todo = make_todo_model(db)
+        db.create_all()
+        for i in xrange(25):
+            todo = Todo('Item %d' % (i % 3), 'text')
+            todo.pub_date = datetime(2013, 1, 1 + i)
+            db.session.add(todo)
+        db.session.commit()
+
+        @app.route('/todos')
+        def todos():
+            return ''
+        self.app = app
+
+    def test_forward_and_back(self):
+        Todo = self.Todo
+        p = Todo.query.seek_paginate([Todo.id], per_page=10)
+        self.assertEqual([t.id for t in p.items], range(1, 11))
+        self.assertFalse(p.has_prev)
+        self.assert_(p.has_next)
+        p = p.next()
+        self.assertEqual([t.id for t in p.items], range(11, 21))
+        self.assert_(p.has_prev)
+        p = p.next()
+        self.assertEqual([t.id for t in p.items], range(21, 26))
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.next_cursor, None)
+        p = p.prev()
+        self.assertEqual([t.id for t in p.items], range(11, 21))
+        self.assert_(p.has_prev)
+        p = p.prev()
+        self.assertEqual([t.id for t in p.items], range(1, 11))
+        self.assertFalse(p.has_prev)
+
+    def test_composite_keys(self):
+        Todo = self.Todo
+        order = [Todo.title.desc(), Todo.pub_date]
+        expected = [t.id for t in Todo.query.order_by(*order)]
+        seen = []
+        p = Todo.query.seek_paginate(order, per_page=4)
+        while True:
+            seen.extend(t.id for t in p.items)
+            if not p.has_next:
+                break
+            p = p.next()
+        self.assertEqual(seen, expected)
+
+    def test_cursor_urls(self):
+        Todo = self.Todo
+        with self.app.test_request_context():
+            p = Todo.query.seek_paginate([Todo.pub_date], per_page=5,
+                                         endpoint='todos')
+            self.assertEqual(p.prev_url, None)
+            self.assertEqual(p.next_url, '/todos?after=' + p.next_cursor)
+            after = squll._decode_cursor(p.next_cursor)
+            self.assertEqual(after, [datetime(2013, 1, 5)])
+        self.assertRaises(NotFound, Todo.query.seek_paginate, [Todo.id],
+                          after='garbage')
+        for values in [{'a': 1}], [[1, 2]], {'$dec': 'nan?'}, 1:
+            self.assertRaises(NotFound, Todo.query.seek_paginate,
+                              [Todo.id], after=squll._encode_cursor(values))
+        self.assertRaises(ValueError, Todo.query.seek_paginate, [Todo.id],
+                          after=squll._encode_cursor([[1]]),
+                          error_out=False)
+
+
 def suite():
     #suite.addTest(unittest.makeSuite())
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BasicAppTestCase))
+    suite.addTest(unittest.makeSuite(QueryRecordingTestCase))
+    suite.addTest(unittest.makeSuite(QueryStatsTestCase))
+    suite.addTest(unittest.makeSuite(NPlusOneTestCase))
     suite.addTest(unittest.makeSuite(TestQueryProperty))
     suite.addTest(unittest.makeSuite(SignallingTestCase))
+    suite.addTest(unittest.makeSuite(BulkTestCase))
+    suite.addTest(unittest.makeSuite(ModificationTrackingTestCase))
+    suite.addTest(unittest.makeSuite(CommitDispatchTestCase))
     suite.addTest(unittest.makeSuite(HelperTestCase))
     suite.addTest(unittest.makeSuite(BindsTestCase))
+    suite.addTest(unittest.makeSuite(InheritedBindTestCase))
+    suite.addTest(unittest.makeSuite(ParallelDDLTestCase))
+    suite.addTest(unittest.makeSuite(ReflectionCacheTestCase))
+    suite.addTest(unittest.makeSuite(EngineRegistryTestCase))
     suite.addTest(unittest.makeSuite(DefaultQueryClassTestCase))
     suite.addTest(unittest.makeSuite(SQLAlchemyIncludesTestCase))
     suite.addTest(unittest.makeSuite(RegressionTestCase))
     suite.addTest(unittest.makeSuite(SessionScopingTestCase))
     suite.addTest(unittest.makeSuite(PaginationTestCase))
+    suite.addTest(unittest.makeSuite(PaginateCountTestCase))
+    suite.addTest(unittest.makeSuite(SeekPaginationTestCase))
+    suite.addTest(unittest.makeSuite(StreamTestCase))
+    suite.addTest(unittest.makeSuite(BakedQueryTestCase))
+    suite.addTest(unittest.makeSuite(ModelCacheTestCase))
+    suite.addTest(unittest.makeSuite(ReplicaTestCase))
+    suite.addTest(unittest.makeSuite(PoolTestCase))
+    suite.addTest(unittest.makeSuite(BindOptionsTestCase))
+    suite.addTest(unittest.makeSuite(ForkTestCase))
+    suite.addTest(unittest.makeSuite(ReleaseConnectionsTestCase))
     return suite
 
 if __name__ == '__main__':